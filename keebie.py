@@ -1,15 +1,32 @@
 #!/usr/bin/env python3
 #Keebie by Robin Universe & Friends
 
-from evdev import InputDevice, categorize, ecodes
 import sys
 import signal
 import os
 import json
+import re
 import argparse
 import time
+import selectors
+import socket
 import subprocess
 import shutil
+import bisect
+import collections
+import struct
+import functools
+import itertools
+import copy
+import fcntl
+import errno
+import atexit
+import ctypes
+
+try:
+    import orjson # Use orjson to parse json files if it is installed, it is several times faster than json
+except ImportError:
+    orjson = None
 
 
 
@@ -38,7 +55,17 @@ layerDir = dataDir + "layers/" # Cache the full path to the /layers directory
 deviceDir = dataDir + "devices/" # Cache the full path to the /devices directory
 scriptDir = dataDir + "scripts/" # Cache the full path to the /scripts directory
 
-pidPath = dataDir + "running.pid" # A Path into which we should store the PID of a running looping instance of keebie
+pidPath = dataDir + "running.pid" # A Path into which we should store the PID of a running looping instance of keebie, advisory only for external tools since we find running instances through lockPath and controlPath
+lockPath = dataDir + "running.lock" # A Path to the file a running looping instance of keebie holds a lock on
+controlPath = dataDir + "control.sock" # A Path to the datagram socket a running looping instance of keebie receives commands on
+
+scriptTypes = { # A dict of script types and thier interpreters with a trailing space
+    "script": "bash ",
+    "py": "python ",
+    "py2": "python2 ",
+    "py3": "python3 ",
+    "exec": "",
+}
 
 
 
@@ -47,6 +74,7 @@ pidPath = dataDir + "running.pid" # A Path into which we should store the PID of
 devicesAreGrabbed = False # A bool to track if devices have beed grabbed
 
 savedPid = False # A bool to store if this process has writen to the PID file
+pidFd = None # The file descriptor of the lock file while we hold a lock on it
 paused = False # A bool to store if the process has sent a pause signal to a running keebie loop
 havePaused = False # A bool to store if this process has been signaled to pause by another instance
 
@@ -56,22 +84,309 @@ def signal_handler(signal, frame):
 def end(): # Properly close the device file and exit the script
     qprint() # Make sure there is a newline
 
-    if devicesAreGrabbed == True: # If we need to clean up grabbed macroDevices
-        ungrabMacroDevices() # Ungrab all devices
-        closeDevices() # Cleanly close all devices
+    sys.exit(0) # Exit without error, cleanUp() will run on the way out
+
+def cleanUp():
+    """Release everything we hold outside of this process, registered with atexit so it runs however we exit (including uncaught exceptions)."""
+    try: # Run every step even if an earlier one fails, so a broken device can't leave our socket and PID file behind
+        if devicesAreGrabbed == True: # If we need to clean up grabbed macroDevices
+            try:
+                ungrabMacroDevices() # Ungrab all devices
+
+            finally:
+                closeDevices() # Cleanly close all devices
+
+    finally:
+        try:
+            if havePaused == True: # if we have told a running keebie loop to pause
+                sendResume() # Tell it to resume
+
+        finally:
+            try:
+                if not controlSocket == None: # If we are receiving commands
+                    closeControl() # Stop, while we still hold our lock
+
+            finally:
+                if savedPid == True: # If we have writen to the PID file
+                    removePid() # Remove our PID file and release our lock
+
+atexit.register(cleanUp) # Run cleanUp() when the interpreter exits
+
+signalPipe = None # The read end of a pipe the interpreter writes the number of every caught signal into, set up by watchSignals()
+signalHandlers = {} # A dict of the functions to run from our event loop for each signal in watchSignals()
+
+def deferSignal(signal, frame):
+    """Do nothing, bound to signals that are handled by handleSignals() from our event loop."""
+    pass
+
+def watchSignals(handlers):
+    """Deliver the signals in the dict handlers through signalPipe so our event loop handles them between reads instead of them interrupting it."""
+    global signalPipe # Globalize signalPipe
+
+    signalPipe, writeEnd = os.pipe() # Create a pipe for the interpreter to write signal numbers into
+    os.set_blocking(signalPipe, False) # Make both ends non-blocking as set_wakeup_fd requires
+    os.set_blocking(writeEnd, False)
+
+    signal.set_wakeup_fd(writeEnd) # Have the interpreter write the number of every signal it catches into the pipe
+    deviceSelector.register(signalPipe, selectors.EVENT_READ, None) # Wake the main loop when a signal arrives
+
+    for signum, handler in handlers.items(): # For every signal we want to handle
+        signalHandlers[signum] = handler # Remember its handler
+        signal.signal(signum, deferSignal) # And catch the signal without doing anything right away
+
+def handleSignals():
+    """Read the signals caught since the last call from signalPipe and run their handlers."""
+    try:
+        signums = os.read(signalPipe, 512) # Read every signal number written so far
+
+    except BlockingIOError: # If there arn't any
+        return
+
+    for signum in signums: # For every caught signal
+        handler = signalHandlers.get(signum) # Get its handler
+        if not handler == None: # If we have one
+            handler(signum, None) # Run it
+
+
+
+# Inter-process communication
+
+def savePid():
+    """Lock the lock file and save our PID into the PID file for external tools, the lock is held until we exit. Raise FileExistsError if another process holds the lock."""
+    dprint("Saving PID to " + pidPath)
+
+    global savedPid # Globalize savedPid
+    global pidFd # Globalize pidFd
+
+    fd = os.open(lockPath, os.O_RDWR | os.O_CREAT, 0o644) # Open the lock file, creating it if needed
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # Try to lock it, the kernel makes sure only one process can
+
+    except BlockingIOError: # If another process holds the lock
+        os.close(fd)
+        dprint("PID already recorded")
+        raise FileExistsError("PID already recorded")
+
+    try:
+        tmpPath = pidPath + ".tmp." + str(os.getpid()) # A path only we will write to
+        tmpFd = os.open(tmpPath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o644) # Create it, truncating anything left behind by a crashed process that had our PID
+        try:
+            os.write(tmpFd, f"{os.getpid()}\n".encode()) # Write our PID into it, newline terminated like other PID files
+            os.fsync(tmpFd)
+
+        finally:
+            os.close(tmpFd)
+
+        os.rename(tmpPath, pidPath) # And move it over the PID file in one step so readers never see a partial PID
+
+    except BaseException: # If we couldn't write the PID file
+        os.close(fd) # Release the lock rather than leaking it
+        raise
+
+    pidFd = fd # Keep the lock file open so we keep the lock
+    savedPid = True # Record that we have saved our PID
+
+def removePid():
+    """Remove the PID file and release our lock. The lock file itself is left in place so a starting instance can't lock a file we are about to unlink."""
+    dprint("Removing PID file " + pidPath)
+
+    global savedPid # Globalize savedPid
+    global pidFd # Globalize pidFd
+
+    if pidFd == None: # If we never locked the lock file
+        print("PID was never stored?")
+        return
+
+    try:
+        os.remove(pidPath) # Remove the PID file while we still hold the lock
+
+    except FileNotFoundError:
+        print("PID was never stored?")
+
+    os.close(pidFd) # Closing the lock file releases the lock
+    pidFd = None
+    savedPid = False # And record it's removal
+
+def sendCommand(command, waitTime=0):
+    """Send the bytes command to a running looping instance of keebie through controlPath and wait up to waitTime seconds for it to acknowledge that it has been handled. Raise FileNotFoundError or ConnectionRefusedError if no instance is running."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as commandSocket:
+        commandSocket.bind("") # Bind to an automatically chosen abstract address so the instance can reply to us
+        commandSocket.sendto(command, controlPath) # Send the command, this fails right away if no instance is bound to controlPath
+
+        if waitTime > 0: # If we should wait for the command to be handled
+            commandSocket.settimeout(waitTime)
+
+            try:
+                commandSocket.recv(16) # Wait for the acknowledgement
+
+            except socket.timeout: # If the instance didn't acknowledge in time
+                dprint("Command not acknowledged")
+
+def sendStop():
+    """If a running instance is listening on controlPath tell it to stop."""
+    try:
+        dprint("Sending stop")
+
+        sendCommand(b"S") # Stop the process
+
+    except (FileNotFoundError, ConnectionRefusedError): # If no instance is listening
+        dprint("No process to stop")
+
+def sendPause(waitSafeTime=None):
+    """If a running instance is listening on controlPath tell it to pause and wait until it has released its devices."""
+    try:
+        dprint("Sending pause")
+
+        if waitSafeTime == None:
+            waitSafeTime = settings.loopDelay * 3 # Set how long we should wait at most
+
+        global havePaused
+        sendCommand(b"P", waitSafeTime) # Pause the process, waiting until it acknowledges it has paused itself or until waitSafeTime runs out
+        havePaused = True # Save that we have paused the process
+
+    except (FileNotFoundError, ConnectionRefusedError): # If no instance is listening
+        dprint("No process to pause")
+
+def sendResume():
+    """If a running instance is listening on controlPath tell it to resume."""
+    try:
+        dprint("Sending resume")
+
+        global havePaused
+        havePaused = False # Save that we have resumed the process
+
+        sendCommand(b"R") # Resume the process
+
+    except (FileNotFoundError, ConnectionRefusedError): # If no instance is listening
+        dprint("No process to resume")
+
+def pause(signal, frame):
+    """Ungrab all macro devices."""
+    global paused
+
+    if paused == True: # If we are already paused
+        return # Our devices are already released
+
+    print("Pausing...")
+
+    paused = True # Save that we have been paused)
+
+    ungrabMacroDevices() # Ungrab all devices so the pausing process can use them
+    closeDevices() # Close our macro devices
+
+def resume(signal, frame):
+    """Grab all macro devices and refresh our settings after being paused (or just refresh our settings if some changes were made we need to load)."""
+    global paused
+
+    getSettings() # Refresh our settings
+
+    if paused == False: # If we aren't paused
+        return # We already hold our devices
+
+    print("Resuming...")
+
+    setupMacroDevices() # Set our macro devices up again to detect changes
+    grabMacroDevices() # Grab all our devices back
+
+    paused = False # Save that we are no longer paused
+
+controlSocket = None # A datagram socket bound to controlPath that other instances send commands to, set up by openControl()
+
+controlHandlers = { # A dict of the functions to run from our event loop for each command sent to controlSocket
+    b"P": pause,
+    b"R": resume,
+    b"S": signal_handler,
+}
+
+def openControl():
+    """Bind controlSocket to controlPath so other instances can send us commands, must only be called while we hold the lock."""
+    global controlSocket # Globalize controlSocket
+
+    try:
+        os.remove(controlPath) # Remove any socket left behind by an instance that didn't exit cleanly, no running instance can be using it since we hold the lock
+
+    except FileNotFoundError:
+        pass
+
+    newSocket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) # Create a datagram socket, each command arrives whole
+    newSocket.bind(controlPath) # Bind it to controlPath
+    newSocket.setblocking(False)
+
+    deviceSelector.register(newSocket, selectors.EVENT_READ, None) # Wake the main loop when a command arrives
+    controlSocket = newSocket # Only now is there a registered socket for closeControl() to undo
+
+def closeControl():
+    """Close controlSocket and remove controlPath."""
+    global controlSocket # Globalize controlSocket
+
+    deviceSelector.unregister(controlSocket) # Stop watching the socket
+    controlSocket.close()
+    controlSocket = None
+
+    try:
+        os.remove(controlPath) # Remove the socket so senders know no instance is running
+
+    except FileNotFoundError:
+        pass
+
+def handleControl():
+    """Receive the commands sent to controlSocket since the last call, run their handlers and acknowledge them to their senders."""
+    while True: # Until we have handled every command
+        try:
+            command, sender = controlSocket.recvfrom(16) # Receive a command and the address of its sender
+
+        except BlockingIOError: # If there arn't any more
+            return
+
+        handler = controlHandlers.get(command) # Get its handler
+        if handler == None: # If we don't have one
+            dprint(f"Unknown command {command}")
+            continue
+
+        handler(None, None) # Run it
 
-    if havePaused == True: # if we have told a running keebie loop to pause
-        sendResume() # Tell it to resume
+        if sender: # If the sender bound an address it can be replied to on
+            try:
+                controlSocket.sendto(command, sender) # Acknowledge the command has been handled
 
-    if savedPid == True: # If we have writen to the PID file
-        removePid() # Remove our PID files
+            except OSError: # If the sender has stopped waiting
+                pass
+
+
+
+# Fast path
+
+signalArguments = { # Arguments that only ask a running instance to do something, and the functions that do so
+    "--pause": functools.partial(sendPause, 0), # Ask a running keebie loop (if one exists) to pause
+    "-P": functools.partial(sendPause, 0),
+    "--resume": sendResume, # Ask a running keebie loop (if one exists) to resume
+    "-R": sendResume,
+    "--stop": sendStop, # Ask a running keebie loop (if one exists) to run end()
+    "-S": sendStop,
+}
+
+if len(sys.argv) == 2 and sys.argv[1] in signalArguments: # If we were only asked to signal a running instance
+    print("Welcome to Keebie")
+    signalArguments[sys.argv[1]]() # Do so before importing evdev or reading any configuration
+    havePaused = False # Leave a paused instance paused when we exit
+    sys.exit(0)
 
-    sys.exit(0) # Exit without error
+from evdev import InputDevice, InputEvent, KeyEvent, ecodes # Only needed past the fast path
 
 
 
 # Key Ledger
 
+keyEventType = ecodes.EV_KEY # Cache the EV_KEY event type for our per-event checks
+keyNames = {code: name[0] if isinstance(name, list) else name for code, name in ecodes.keys.items()} # A dict of keycodes by event code, using the first keycode for codes that have several
+
+inputEventStruct = struct.Struct("llHHi") # The layout of a kernel input_event: seconds, microseconds, type, code, value
+
+eviocsmask = 0x40104593 # The EVIOCSMASK ioctl, _IOW('E', 0x93, struct input_mask)
+eventTypeMask = ctypes.c_uint64(1 << ecodes.EV_SYN | 1 << ecodes.EV_KEY) # A bitmap of the event types we want delivered, EV_SYN must stay or the kernel never wakes us
+eventTypeMaskArg = struct.pack("IIQ", 0, ctypes.sizeof(eventTypeMask), ctypes.addressof(eventTypeMask)) # A struct input_mask filtering event types (type 0) with our bitmap
+
 class keyLedger():
     """A class for tracking which keys are pressed, as well how how long and how recently."""
     def __init__(self, name="unnamed ledger"):
@@ -82,38 +397,24 @@ class keyLedger():
         self.peaking = False # Are we peaking (adding new keys; rising or holding)
         
         self.history = "" # Current history of recent key peaks
-        self.histories = [] # List of flushed histories
+        self.histories = collections.deque() # Queue of flushed histories
 
         self.newKeys = [] # List of keys newly down
         self.lostKeys = [] # List of keys newly lost
         self.downKeys = [] # List of keys being held down
+        self.downSet = set() # Set of keys being held down, kept in sync with downKeys for fast membership tests
 
     def newKeysStr(self):
         """Return a str of concatenated new keys."""
-        keysParsed = ""
-        
-        for keycode in self.newKeys: # For all new keys
-            keysParsed += keycode + "+" # Add them to the string along with a "+"
-            
-        return keysParsed.rstrip("+") # Return the string we built with the trailing "+" stripped
+        return "+".join(self.newKeys) # Join our new keys with "+"s
 
     def lostKeysStr(self):
         """Return a str of concatenated lost keys."""
-        keysParsed = ""
-        
-        for keycode in self.lostKeys: # For all lost keys
-            keysParsed += keycode + "+" # Add them to the string along with a "+"
-
-        return keysParsed.rstrip("+") # Return the string we built with the trailing "+" stripped
+        return "+".join(self.lostKeys) # Join our lost keys with "+"s
 
     def downKeysStr(self):
         """Return a str of concatenated down keys."""
-        keysParsed = ""
-        
-        for keycode in self.downKeys: # For all down keys
-            keysParsed += keycode + "+" # Add them to the string along with a "+"
-
-        return keysParsed.rstrip("+") # Return the string we built with the trailing "+" stripped
+        return "+".join(self.downKeys) # Join our down keys with "+"s
         
     def stateChange(self, newState, timestamp = None):
         """Change the ledger state and record the timestamp."""
@@ -139,37 +440,54 @@ class keyLedger():
             entry = self.downKeysStr() # Use the currently down keys
 
         if held == None: # If the whether the key was held was not specified
-            held = self.stateDuration((timestamp)) > settings["holdThreshold"] # Set held True if the length of last state surpassed holdThreshold setting
+            held = self.stateDuration((timestamp)) > settings.holdThreshold # Set held True if the length of last state surpassed holdThreshold setting
 
-        entry += "+HELD" * held # If held is True note that into the entry
+        entry = f"{entry}{'+HELD' if held else ''}" # If held is True note that into the entry
 
         if not self.history == "": # If the current history is not empty
             self.history += "-" # Add a "-" to our history to separate key peaks
 
         self.history += entry # Add entry to our history
 
-        dprint(f"{self.name}) added {entry} to history")
+        if printDebugs == True: # Only build the debug string if we will print it
+            dprint(f"{self.name}) added {entry} to history")
         # dprint(f"{self.name}) history is \"{self.history}\"")
 
     def flushHistory(self):
-        """Flush our current history into our histories list."""
-        dprint(f"{self.name}) flushing {self.history}")
+        """Flush our current history into our histories queue."""
+        if printDebugs == True: # Only build the debug string if we will print it
+            dprint(f"{self.name}) flushing {self.history}")
 
-        self.histories += [self.history, ] # Add our history to our histories
+        self.histories.append(sys.intern(self.history)) # Add our history to our histories, interned so repeated histories share one str and match layer keys by identity
         self.history = "" # Clear our history
 
+    def flushDeadline(self):
+        """Return the timestamp at which our history is due to be flushed, or None if we are not waiting to flush anything."""
+        if self.history == "" or not self.downKeys == []: # If there is nothing to flush or keys are still held
+            return None # Only new events can lead to a flush
+
+        if self.state == 3: # If we are already stale
+            return self.stateChangeStamp + settings.flushTimeout # We will flush once the stale state has lasted flushTimeout
+
+        return time.time() # Otherwise we need an update right away to become stale
+
     def popHistory(self):
-        """Pop the nest item out of our histories list and return it, returns a blank string if no history is available."""
+        """Pop the nest item out of our histories queue and return it, returns a blank string if no history is available."""
         try: # Try to..
-            dprint(f"{self.name}) popping {self.histories[0]}")
-            return self.histories.pop(0) # Pop and return the first element of our histories list
+            if printDebugs == True: # Only build the debug string if we will print it
+                dprint(f"{self.name}) popping {self.histories[0]}")
+            return self.histories.popleft() # Pop and return the first element of our histories queue
 
         except IndexError: # If no history is available
             return "" # Return an empty string
 
     def update(self, events=()):
-        """Update the ledger with an iteratable of key events (or Nones to update timers)."""
+        """Update the ledger with an iteratable of raw (timestamp, type, code, value) event tuples or InputEvents (or Nones to update timers)."""
         flushedHistory = False # A bool to store if we flushed any histories this update
+
+        multiKeyMode = settings.multiKeyMode # Snapshot the settings we use so the per-event loop reads locals
+        holdThreshold = settings.holdThreshold
+        flushTimeout = settings.flushTimeout
         
         for event in events: # For each passed event
             self.newKeys = [] # They are no longer new
@@ -177,62 +495,75 @@ class keyLedger():
 
             timestamp = None # A float (or None) for the timestamp of the event, will be passed to other methods
             if not event == None: # If the event is not None
-                timestamp = event.timestamp() # Set timestamp to the event's timestamp
+                if isinstance(event, InputEvent): # If we were passed an evdev InputEvent
+                    event = (event.timestamp(), event.type, event.code, event.value) # Convert it to a raw event tuple
+
+                timestamp, eventType, code, keystate = event # Unpack the event, for key events the value is the key state
                 
-                if event.type == ecodes.EV_KEY: # If the event is a related to a key, as opposed to a mouse movement or something (At least I think thats what this does)
-                    event = categorize(event) # Convert our EV_KEY input event into a KeyEvent
-                    keycode = event.keycode # Store the event's keycode
-                    keystate = event.keystate # Store the event's key state
+                if eventType == keyEventType: # If the event is a related to a key, as opposed to a mouse movement or something (At least I think thats what this does)
+                    keycode = keyNames.get(code) # Look up the event's keycode
+                    if keycode == None: # If the code has no name
+                        keycode = str(code) # Use the number itself
 
                     # dprint(timestamp)
 
-                    if type(keycode) == list: # If the keycode is a list of keycodes (it can happen) 
-                        keycode = keycode[0] # Select the first one
-
-                    if keystate in (event.key_down, event.key_hold): # If the key is down
-                        if not keycode in self.downKeys: # If the key is not known to be down
-                            self.newKeys += [keycode, ] # Add the key to our new keys
+                    if keystate in (KeyEvent.key_down, KeyEvent.key_hold): # If the key is down
+                        if not keycode in self.downSet: # If the key is not known to be down
+                            self.newKeys.append(keycode) # Add the key to our new keys
 
-                    elif keystate == event.key_up: # If the key was released
-                        if keycode in self.downKeys: # If the key was in our down keys
-                            self.lostKeys += [keycode, ] # Add the key to our lost keys
+                    elif keystate == KeyEvent.key_up: # If the key was released
+                        if keycode in self.downSet: # If the key was in our down keys
+                            self.lostKeys.append(keycode) # Add the key to our lost keys
 
                         else: # If the key was not known to be down
                             print(f"{self.name}) Untracked key {keycode} released.") # Print a warning
 
-            if not self.newKeys == []: # if we have new keys (rising edge)
+            if self.newKeys: # if we have new keys (rising edge)
                 # dprint()
-                dprint(f"{self.name}) >{'>' * len(self.downKeys)} " \
-                    f"rising with new keys {self.newKeysStr()}")
+                if printDebugs == True: # Only build the debug string if we will print it
+                    dprint(f"{self.name}) >{'>' * len(self.downKeys)} " \
+                        f"rising with new keys {self.newKeysStr()}")
                 
-                self.downKeys += self.newKeys # Add our new keys to our down keys
-                self.peaking = True # Store that we are peaking
+                self.downSet.update(self.newKeys) # Add our new keys to our down set
+
+                if multiKeyMode == "combination": # If we are in combination mode
+                    for keycode in self.newKeys: # For each new key
+                        bisect.insort(self.downKeys, keycode) # Add it to our down keys keeping them sorted to negate the order they were added in
+
+                else:
+                    self.downKeys.extend(self.newKeys) # Add our new keys to our down keys in the order they were added
 
-                if settings["multiKeyMode"] == "combination": # If we are in combination mode
-                    self.downKeys.sort() # Sort our down keys to negate the order they were added in
+                self.peaking = True # Store that we are peaking
                 
                 self.stateChange(0, timestamp) # Change to state 0
 
-            elif not self.lostKeys == []: # If we lost keys (falling edge)
+            elif self.lostKeys: # If we lost keys (falling edge)
                 # dprint()
-                dprint(f"{self.name}) {'<' * len(self.downKeys)}" \
-                    f" falling with lost keys {self.lostKeysStr()}")
+                if printDebugs == True: # Only build the debug string if we will print it
+                    dprint(f"{self.name}) {'<' * len(self.downKeys)}" \
+                        f" falling with lost keys {self.lostKeysStr()}")
 
                 if self.peaking == True: # If we were peaking
-                    self.addHistoryEntry(timestamp=timestamp) # Add current down keys (peak keys) to our history
+                    self.addHistoryEntry(held=self.stateDuration(timestamp) > holdThreshold) # Add current down keys (peak keys) to our history, noting if they were held longer than holdThreshold
                     self.peaking = False # We are no longer peaking
                     
                 for keycode in self.lostKeys: # For each lost key
-                    self.downKeys.remove(keycode) # Remove it from our down keys
+                    if multiKeyMode == "combination": # If our down keys are sorted
+                        del self.downKeys[bisect.bisect_left(self.downKeys, keycode)] # Find and remove it with a binary search
+
+                    else:
+                        self.downKeys.remove(keycode) # Remove it from our down keys
+
+                    self.downSet.discard(keycode) # And our down set
                 
                 self.stateChange(1, timestamp) # Change to state 1
                 
-            elif not self.downKeys == []: # If no keys were added or lost, but we still have down keys (holding)
+            elif self.downKeys: # If no keys were added or lost, but we still have down keys (holding)
                 # dprint(end = f"{self.name}) {'-' * len(self.downKeys)}" \
                 #     f" holding with down keys {self.downKeysStr()}" \
                 #     f" since {str(self.stateChangeStamp)[7:17]}" \
                 #     f" for {str(self.stateDuration(timestamp))[0:10]}" \
-                #     f" {'held' * (self.stateDuration((timestamp)) > settings['holdThreshold'])}\r")
+                #     f" {'held' if self.stateDuration(timestamp) > holdThreshold else ''}\r")
 
                 self.stateChange(2, timestamp) # Change to state 2
 
@@ -242,7 +573,7 @@ class keyLedger():
 
                 self.stateChange(3, timestamp) # Change to state 3
 
-                if self.stateDuration(timestamp) > settings["flushTimeout"] and not self.history == "": # If the duration of this stale state has surpassed flushTimeout setting
+                if not self.history == "" and self.stateDuration(timestamp) > flushTimeout: # If we have a history and the duration of this stale state has surpassed flushTimeout setting
                     # dprint()
                     self.flushHistory() # Flush our current history
                     flushedHistory = True # Store that we did so
@@ -266,15 +597,15 @@ class macroDevice():
         self.currentLayer = self.initialLayer # Layer this device is currently on
         self.ledger = keyLedger(self.name) # A keyLedger to track input events on his devicet
         self.device = None # will be an InputEvent instance
+        self.grabbed = False # Whether we have grabbed the device and are watching it in deviceSelector
+        self.capabilities = {} # Cache of the grabbed device's capabilities
+        self.ledList = [] # Cache of the LEDs the grabbed device has
 
     def addUdevRule(self, priority = 85):
         """Generate a udev rule for this device."""
         path = f"{priority}-keebie-{self.name}.rules" # Name of the file for the rule
-        rule = ""
-
-        for test in self.udevTests: # For all the udev tests
-            rule += test + ", " # Add them together with commas
-            dprint(rule)
+        rule = "".join([test + ", " for test in self.udevTests]) # Add all the udev tests together with commas
+        dprint(rule)
 
         writeJson(self.name + ".json", {"udev_rule": path}, deviceDir) # Save the udev rule filepath for removeDevice()
 
@@ -286,7 +617,27 @@ class macroDevice():
         """Grab the device and set self.device to the grabbed device."""
         qprint("grabbing device " + self.name)
         self.device = InputDevice(self.eventFile) # Set self.device to the device of self.eventFile
-        self.device.grab() # Grab the device
+
+        for attempt in range(50): # Try to grab the device for up to about half a second
+            try:
+                self.device.grab() # Grab the device
+                break
+
+            except OSError as error:
+                if not error.errno == errno.EBUSY or attempt == 49: # If something other than another process holding the device went wrong, or we are out of tries
+                    self.close() # Don't leave the device open
+                    raise
+
+                time.sleep(.01) # Wait a moment for the other process (likely an instance we just paused or stopped) to release it
+
+        try:
+            fcntl.ioctl(self.device.fd, eviocsmask, eventTypeMaskArg) # Have the kernel drop events we ignore (like EV_MSC scancodes) before they reach us
+
+        except OSError: # If the kernel (or device) doesn't support event masks
+            dprint("Can't mask events of " + self.name)
+
+        self.capabilities = self.device.capabilities() # Cache the device's capabilities, they won't change while we have it grabbed
+        self.ledList = self.capabilities.get(17, []) # Cache a list of LEDs the device has
 
         self.setLeds() # Set the leds based on the current layer
 
@@ -295,20 +646,40 @@ class macroDevice():
         qprint("ungrabbing device " + self.name)
         self.device.ungrab() # Do the thing that got said twice
 
+        self.capabilities = {} # Forget the cached capabilities, the device may change before we grab it again
+        self.ledList = []
+
     def close(self):
         """Try to close the device file gracefully."""
+        if self.device == None: # If the device was never opened (or is already closed)
+            return
+
         qprint("closing device " + self.name)
 
         self.device.close() # Close the device
+        self.device = None
 
     def read(self, process=True):
-        """Read all queued events (if any), update the ledger, and process the keycodes (or don't)."""
-        flushedHistories = False # A bool to store if we flushed any histories this update
+        """Read queued events (if any), update the ledger, and process the keycodes (or don't)."""
+        events = [] # A list to collect every queued event
         try: # Try to...
-            flushedHistories = self.ledger.update(self.device.read()) # Update our ledger with any available events
+            for chunk in range(4): # Keep reading until the kernel buffer is drained, but at most 1024 events so a flooding device can't starve the others (select will wake us again for the rest)
+                buffer = os.read(self.device.fd, inputEventStruct.size * 256) # Read up to 256 raw events with a single syscall
+                if not buffer: # If the device has gone away
+                    break
 
-        except BlockingIOError: # If no events are available
-            flushedHistories = self.ledger.update((None, )) # Update our ledger so things get flushed if need be
+                for sec, usec, eventType, code, value in inputEventStruct.iter_unpack(buffer): # For each event we read
+                    events.append((sec + usec / 1000000, eventType, code, value)) # Add it to our list as a lightweight tuple
+
+        except BlockingIOError: # Once no more events are available
+            pass
+
+        flushedHistories = self.ledger.update(events or (None, )) # Update our ledger with all the events at once (or with None so things get flushed if need be)
+
+        if process == True and not self.ledger.history == "" and self.ledger.downKeys == []: # If we are processing and all keys of a history have been released
+            if not self.ledger.history in loadLayer(self.currentLayer)[1]: # If no binding in our layer starts with it
+                self.ledger.flushHistory() # Flush it now rather than waiting flushTimeout for keys that can't change the outcome
+                flushedHistories = True
 
         if process == True and flushedHistories == True: # If we are processing the ledger
             self.processLedger() # Process the newly updated ledger
@@ -317,14 +688,14 @@ class macroDevice():
 
     def setLeds(self):
         """Set device leds bassed on current layer."""
-        if "leds" in readJson(self.currentLayer): # If the current layer specifies LEDs
-            if 17 in self.device.capabilities().keys(): # Check if the device had LEDs
-                leds = self.device.capabilities()[17] # Get a list of LEDs the device has
+        layerJson = readJson(self.currentLayer) # Read the current layer once, it is cached until the file changes
 
-                onLeds = readJson(self.currentLayer)["leds"] # Get a list of LEDs to turn on
+        if "leds" in layerJson: # If the current layer specifies LEDs
+            if 17 in self.capabilities: # Check if the device had LEDs
+                onLeds = frozenset(layerJson["leds"]) # Get a set of LEDs to turn on
                 dprint(f"device {self.name} setting leds {onLeds} on")
 
-                for led in leds: # For all LEDs on the board
+                for led in self.ledList: # For all LEDs on the board
                     if led in onLeds: # If the LED is to be set on
                         self.device.set_led(led, 1) # Set it on
                     else:
@@ -334,69 +705,57 @@ class macroDevice():
                 dprint("Device has no LEDs")
 
         else:
-            print(f"Layer {readJson(self.currentLayer)} has no leds property, writing empty")
+            print(f"Layer {layerJson} has no leds property, writing empty")
             writeJson(self.currentLayer, {"leds": []}) # Write an empty list for LEDs into the current layer
-            leds = self.device.capabilities()[17] # Get a list of LEDs the device has
 
-            for led in leds: # For all LEDs on the board
+            for led in self.ledList: # For all LEDs on the board
                 self.device.set_led(led, 0) # Set it off
 
     def processLedger(self):
         """Process any flushed histories from our ledger."""
-        keycode = self.ledger.popHistory() # Pop a history
-        while not keycode == "": # As long as the history we have isn't blank
+        while syncPid == None: # Unless a sync: command is running (the rest of our histories wait in the ledger until it exits)
+            keycode = self.ledger.popHistory() # Pop a history
+            if keycode == "": # If there are none left
+                break
+
             self.processKeycode(keycode) # Process it
-            keycode = self.ledger.popHistory() # And grab the next one (blank if none are available)
         
     def processKeycode(self, keycode):
-        """Parse a command in our current layer bound to the passed keycode (ledger history)."""
-        dprint(f"{self.name} is processing {keycode} in layer {self.currentLayer}") # Print debug info
+        """Run the action in our current layer bound to the passed keycode (ledger history)."""
+        if printDebugs == True: # Only build the debug string if we will print it
+            dprint(f"{self.name} is processing {keycode} in layer {self.currentLayer}") # Print debug info
 
-        if keycode in readJson(self.currentLayer): # If the keycode is in our current layer's json file
-            value = readJson(self.currentLayer)[keycode] # Get the instructions associated with the keycode
-            value = parseVars(value, self.currentLayer) # Parse any varables that may appear in the command
+        action = loadLayer(self.currentLayer)[0].get(keycode) # Get the pre-compiled action bound to the keycode in our current layer
+        if not action == None: # If the keycode is bound
+            action(self) # Run the action on this device
 
-            if value.startswith("layer:"): # If value is a layerswitch command
-                if os.path.exists(layerDir+value.split(':')[-1] + ".json") == False: # If the layer has no json file
-                    createLayer(value.split(':')[-1]+".json") # Create one
-                    print("Created layer file: " + value.split(':')[-1]+".json") # Notify the user
-                    self.currentLayer = value.split(':')[-1] + ".json" # Switch to our new layer file
-                    print("Switched to layer file: " + value.split(':')[-1] + ".json") # Notify the user
+    def switchLayer(self, layer):
+        """Switch to the passed layer file, creating it if need be."""
+        if os.path.exists(layerDir + layer) == False: # If the layer has no json file
+            createLayer(layer) # Create one
+            print("Created layer file: " + layer) # Notify the user
 
-                else:
-                    self.currentLayer = value.split(':')[-1] + ".json" # Set self.current layer to the target layer
-                    print("Switched to layer file: " + value.split(':')[-1] + ".json") # Notify the user
+        self.currentLayer = layer # Set self.current layer to the target layer
+        print("Switched to layer file: " + layer) # Notify the user
 
-                self.setLeds() # Set LEDs based on the new current layer
+        self.setLeds() # Set LEDs based on the new current layer
 
-            else:
-                if value.strip().endswith("&") == False and settings["forceBackground"]: # If value is not set in run in the background and our settings say to force running in the background
-                    value += " &" # Force running in the background
-                    
-                if value.strip().endswith("&") == False and settings["backgroundInversion"]: # If value is not set to run in the background and our settings say to invert background mode
-                    value += " &" # Force running in the background
-                
-                elif value.strip().endswith("&") and settings["backgroundInversion"]: # Else if value is set to run in the background and our settings say to invert background mode
-                    value = value.rstrip(" &") # Remove all spaces and &s from the end of value, there might be a better way but this is the best I've got
-
-                scriptTypes = { # A dict of script types and thier interpreters with a trailing space
-                    "script": "bash ",
-                    "py": "python ",
-                    "py2": "python2 ",
-                    "py3": "python3 ",
-                    "exec": "",
-                }
-
-                for scriptType in scriptTypes.keys(): # For recognized script types
-                    if value.startswith(scriptType + ":"): # Check if value is one of said script types
-                        print(f"Executing {scriptTypes[scriptType]}script {value.split(':')[-1]}") # Notify the user we re running a script
-                        value = scriptTypes[scriptType] + scriptDir + value.split(':')[-1] # Set value to executable format
-                        break # Break the loop
-                
-                else: # If this is not a script (i.e. it is a shell command)
-                    print(keycode+": "+value) # Notify the user of the command
-                
-                os.system(value) # Execute value
+    def runCommand(self, argv, message, wait):
+        """Spawn the passed argv, waiting for it to finish if wait is True."""
+        print(message) # Notify the user of the command
+
+        try:
+            pid = os.posix_spawnp(argv[0], argv, os.environ, setsid=True) # Spawn the command in its own session, searching PATH for it, without copying our address space like fork() would
+
+        except OSError as error: # If the command couldn't be started (without a shell to report it for us)
+            print(f"Failed to run {argv[0]}: {error.strerror}")
+            return
+
+        childPids.add(pid) # Keep track of it so we can reap it once it exits
+
+        if wait == True: # If the command should run in the foreground
+            global syncPid
+            syncPid = pid # Hold off processing more histories until reapChildren() sees it exit, without blocking our event loop
 
     def clearLedger(self):
         """Clear this devices ledger."""
@@ -412,39 +771,44 @@ class macroDevice():
 
 macroDeviceList = [] # List of macroDevice instances
 
+deviceSelector = selectors.DefaultSelector() # A selector (epoll on Linux) to wait on the file descriptors of grabbed devices
+
+childPids = set() # A set of PIDs of commands we have launched and not yet reaped
+syncPid = None # The PID of a sync: command we must wait for before processing more histories, None if there isn't one
+
 standardLeds = { # A dict of standard LED ids and thier names
     0: "num lock",
     1: "caps lock",
     2: "scroll lock",
 }
 
+standardLedsMenu = "standard LEDs:\n" + "\n".join(f"-{led}: {ledName}" for led, ledName in standardLeds.items()) # The LED menu shown by the shells, formatted once since standardLeds never changes
+
 def setupMacroDevices():
     """Setup a macroDevice instance based on the contents of deviceDir."""
-    global macroDeviceList # Globalize macroDeviceList
-    deviceJsonList = [deviceJson for deviceJson in os.listdir(deviceDir) if os.path.splitext(deviceJson)[1] == ".json"] # Get list of json files in deviceDir
-    
+    with os.scandir(deviceDir) as entries: # Scan deviceDir
+        deviceJsonList = [entry.name for entry in entries if entry.name.endswith(".json") and entry.is_file()] # Get list of json files in deviceDir
+
     dprint(deviceJsonList) # Print debug info
     dprint([device.name for device in macroDeviceList])
 
-    for device in macroDeviceList: # For all preexisting devices
-        if not device.name + ".json" in deviceJsonList: # If a preexisting device is not in our list of devices
-            dprint(f"Device {device.name} has been removed")
-            macroDeviceList.remove(device) # Delete it (It should already be closed)
+    knownDevices = {device.name + ".json": device for device in macroDeviceList} # A dict of preexisting devices by json file
 
-    dprint([device.name for device in macroDeviceList])
+    for deviceJson in knownDevices.keys() - set(deviceJsonList): # For all preexisting devices that are no longer in deviceDir
+        dprint(f"Device {deviceJson} has been removed")
+
+    macroDeviceList.clear() # Rebuild our list of devices (removed devices should already be closed)
 
-    newMacroDeviceList = [] # Set up an empty list for new devices
     for deviceJson in deviceJsonList: # For all json files in deviceDir
-        for device in macroDeviceList: # For all preexisting devices
-            if deviceJson == device.name + ".json": # If the new device is already known
-                dprint(f"Device {device.name} already known")
-                break
+        if deviceJson in knownDevices: # If the device is already known
+            dprint(f"Device {deviceJson} already known")
+            macroDeviceList.append(knownDevices[deviceJson]) # Keep its macroDevice instance
 
-        else: # If the loop was never broken
+        else:
             dprint("New device " + deviceJson)
-            newMacroDeviceList += [macroDevice(deviceJson), ] # Set up a macroDevice instance for all files and save them to newMacroDeviceList
+            macroDeviceList.append(macroDevice(deviceJson)) # Set up a macroDevice instance for the file
 
-    macroDeviceList += newMacroDeviceList # Add the list ofnew devices to the list of preexisting ones
+    dprint([device.name for device in macroDeviceList])
 
 def grabMacroDevices():
     """Grab all devices with macroDevices."""
@@ -453,6 +817,8 @@ def grabMacroDevices():
 
     for device in macroDeviceList:
         device.grabDevice()
+        deviceSelector.register(device.device.fd, selectors.EVENT_READ, device) # Wake the main loop when the device has events
+        device.grabbed = True # Only now is there a grab and a registration to undo
 
 def ungrabMacroDevices():
     """Ungrab all devices with macroDevices."""
@@ -460,6 +826,11 @@ def ungrabMacroDevices():
     devicesAreGrabbed = False # And set it false
 
     for device in macroDeviceList:
+        if device.grabbed == False: # If we never grabbed and registered the device (or already ungrabbed it)
+            continue
+
+        device.grabbed = False
+        deviceSelector.unregister(device.device.fd) # Stop watching the device
         device.ungrabDevice()
 
 def closeDevices():
@@ -470,13 +841,14 @@ def closeDevices():
 def mergeDeviceLedgers():
     """Merge the key ledgers of all macroDevices into one and return it."""
     returnLedger = keyLedger() # Create an empty key ledger
+    chain = itertools.chain.from_iterable # Lazily chain the lists of all devices
     
-    for device in macroDeviceList: # For all macroDevices
-        returnLedger.newKeys += device.ledger.newKeys # Add the devices key lists to the return ledger
-        returnLedger.lostKeys += device.ledger.lostKeys
-        returnLedger.downKeys += device.ledger.downKeys
+    returnLedger.newKeys = list(chain(device.ledger.newKeys for device in macroDeviceList)) # Add the devices key lists to the return ledger
+    returnLedger.lostKeys = list(chain(device.ledger.lostKeys for device in macroDeviceList))
+    returnLedger.downKeys = list(chain(device.ledger.downKeys for device in macroDeviceList))
+    returnLedger.downSet = set(returnLedger.downKeys)
 
-        returnLedger.histories += device.ledger.histories # Add the devices histories to the return ledger
+    returnLedger.histories = collections.deque(chain(device.ledger.histories for device in macroDeviceList)) # Add the devices histories to the return ledger
 
     return returnLedger # Return the ledger we built
 
@@ -486,46 +858,123 @@ def clearDeviceLedgers():
         device.clearLedger()
 
 def readDevices(process=True):
-    """Read and optionally process all devices events."""
+    """Wait until a device has events or a history is due to be flushed, then read and optionally process the devices that need it."""
     flushedHistories = False # A bool to store if we flushed any histories this update
-    for device in macroDeviceList: # For all macroDevices
-        if device.read(process) == True: # If any of our devices flush any histories
+    signalsPending = False # A bool to store if signalPipe has signals for us to handle
+    commandsPending = False # A bool to store if controlSocket has commands for us to handle
+    readyKeys = deviceSelector.select(getFlushWait()) # Sleep until a device has events, a signal arrives, a layer file changes, or a history is due to be flushed
+
+    for key, mask in readyKeys: # For everything that is ready
+        if key.fd == layerWatchFd: # If layer files have changed
+            readLayerEvents() # Forget compiled layers before we process any keys with them
+
+    for key, mask in readyKeys: # For everything that is ready
+        if key.fd == layerWatchFd: # If it is our layer watch
+            continue # We have already handled it
+
+        elif not controlSocket == None and key.fd == controlSocket.fileno(): # If controlSocket is ready
+            commandsPending = True # Handle the commands once we are done with the devices, since they may ungrab and replace them
+
+        elif key.data == None: # If signalPipe is ready
+            signalsPending = True # Handle the signals once we are done with the devices, since they may ungrab and replace them
+
+        elif paused == False and key.data.read(process) == True: # Read the devices that have events, if any of them flush any histories
             flushedHistories = True # Store that
 
+    for device in macroDeviceList: # For all macroDevices
+        deadline = device.ledger.flushDeadline() # Get when the device's history is due to be flushed
+        if paused == False and not deadline == None and deadline <= time.time(): # If it is due
+            if device.read(process) == True: # Read the device to flush it
+                flushedHistories = True # Store that
+
+    if signalsPending == True: # If signals arrived
+        handleSignals() # Handle them
+
+    if commandsPending == True: # If commands arrived
+        handleControl() # Handle them
+
     return flushedHistories # Return whether we flushed any histories
 
+def getFlushWait():
+    """Return how many seconds we can wait for events before a device history is due to be flushed, or None if we can wait indefinitely."""
+    if paused == True: # If we are paused
+        return None # Nothing will be flushed until we resume
+
+    deadlines = [device.ledger.flushDeadline() for device in macroDeviceList] # Get when each device's history is due
+    deadlines = [deadline for deadline in deadlines if not deadline == None] # Ignore devices with nothing to flush
+
+    if deadlines == []: # If no device has a history to flush
+        return None # Wait for events indefinitely
+
+    return max(min(deadlines) - time.time(), 0) # Wait until the earliest deadline
+
+def reapChildren(signal, frame):
+    """Reap any of our commands that have exited so they don't linger as zombies, and process the histories held back by a finished sync: command, bound to SIGCHLD."""
+    global syncPid
+
+    for pid in list(childPids): # For all commands
+        try:
+            if not os.waitpid(pid, os.WNOHANG)[0] == 0: # If it has exited reap it
+                childPids.discard(pid) # And stop tracking it
+
+        except ChildProcessError: # If it has already been reaped
+            childPids.discard(pid) # Stop tracking it
+
+    if not syncPid == None and not syncPid in childPids: # If the sync: command we were waiting for has exited
+        syncPid = None
+
+        if paused == False: # If we are processing keys
+            for device in macroDeviceList: # For all macroDevices
+                device.processLedger() # Process the histories that queued up while it ran
+
 def popDeviceHistories():
     """Pop and return all histories of all devices as a list."""
-    histories = [] # A list for poped histories
-    for device in macroDeviceList: # For all macroDevices
-        keycode = device.ledger.popHistory() # Pop a history
-        while not keycode == "": # As long as the history we have isn't blank
-            histories += [keycode, ] # Add it to the list
-            keycode = device.ledger.popHistory() # And grab the next one (blank if none are available)
-
-    return histories # Return the histories we got
+    return [keycode for device in macroDeviceList for keycode in iter(device.ledger.popHistory, "")] # Pop histories from each device until it returns a blank one
 
 
 
 # JSON
 
+jsonCache = {} # A dict of parsed json files keyed by (path, modification time)
+
+def forgetJson(path): # Drop all cached versions of the json file at path
+    for cacheKey in [cacheKey for cacheKey in jsonCache if cacheKey[0] == path]:
+        jsonCache.pop(cacheKey)
+
 def readJson(filename, dir = layerDir): # Reads the file contents of a layer (or any json file named filename in the directory dir)
-    with open(dir+filename) as f:
-        data = json.load(f)
+    path = dir + filename
+    cacheKey = (path, os.stat(path).st_mtime_ns) # Key the cache on the file's modification time so edits are picked up
+
+    data = jsonCache.get(cacheKey) # Check if we have already parsed this version of the file
+    if data == None: # If we haven't
+        if orjson == None: # If orjson isn't installed
+            with open(path) as f:
+                data = json.load(f)
+
+        else:
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read()) # Parse the raw bytes with orjson
+
+        forgetJson(path) # Forget older versions of the file
+        jsonCache[cacheKey] = data # Cache the parsed data
 
-    return data 
+    return copy.deepcopy(data) # Return a copy so callers can't mutate our cache
+
+def dumpJson(filename, data, dir = layerDir): # Writes data to a layer (or any json file named filename in the directory dir)
+    forgetJson(dir+filename) # Invalidate the cached file
+
+    with open(dir+filename, 'w+') as outfile:
+        json.dump(data, outfile, indent=3)
 
 def writeJson(filename, data, dir = layerDir): # Appends new data to a specified layer (or any json file named filename in the directory dir)
     try: # Try to...
-        with open(dir+filename) as f: # Open an existing file
-            prevData = json.load(f) # And copy store its data
+        prevData = readJson(filename, dir) # Get the existing data of the file
     except FileNotFoundError: # If the file doesn't exist
         prevData = {}
 
     prevData.update(data)
 
-    with open(dir+filename, 'w+') as outfile:
-        json.dump(prevData, outfile, indent=3)
+    dumpJson(filename, prevData, dir)
 
 def popDictRecursive(dct, keyList): # Given a dict and list of key names of dicts follow said list into the dicts recursivly and pop the finall result, it's hard to explain 
     if len(keyList) == 1:
@@ -535,117 +984,234 @@ def popDictRecursive(dct, keyList): # Given a dict and list of key names of dict
         popDictRecursive(dct[keyList[0]], keyList[1:])
 
 def popJson(filename, key, dir = layerDir): # Removes the key key and it's value from a layer (or any json file named filename in the directory dir)
-    with open(dir+filename) as f:
-        prevData = json.load(f)
+    prevData = readJson(filename, dir)
 
-    if type(key) == str:
+    if isinstance(key, str):
         prevData.pop(key)
-    elif type(key) == list:
+    elif isinstance(key, list):
         popDictRecursive(prevData, key)
 
-    with open(dir+filename, 'w+') as outfile:
-        json.dump(prevData, outfile, indent=3)
+    dumpJson(filename, prevData, dir)
 
 
 
 # Layer file
 
-def createLayer(filename): # Creates a new layer with a given filename
-    shutil.copyfile(installDataDir + "/data/layers/default.json", layerDir + filename) # Copy the provided default layer file from installedDataDir to specified filename
+def createLayer(filename): # Creates a new layer with a given filename, raising FileExistsError rather than overwriting an existing one
+    with open(installDataDir + "/data/layers/default.json", "rb") as templateFile, open(layerDir + filename, "xb") as layerFile: # Open the provided default layer file from installedDataDir and exclusively create the specified filename
+        shutil.copyfileobj(templateFile, layerFile) # Copy the template into it
+
+layerCache = {} # A dict of compiled layers keyed by (filename, modification time), or by (filename, None) while layerWatchFd is watching for changes
+
+shellCharRe = re.compile(r"[|&;<>()$`\\\"'*?\[\]#~={}\n]") # A regex matching characters that only a shell can interpret, commands without them are split on whitespace and run directly
+
+layerWatchFd = None # An inotify file descriptor watching layerDir for changes, None if we haven't set one up and must stat layer files instead
+
+inotifyFlags = 0x2 | 0x8 | 0x40 | 0x80 | 0x200 # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+inotifyEventStruct = struct.Struct("iIII") # The layout of the fixed part of a struct inotify_event: watch descriptor, mask, cookie, name length
+
+def inotifyWatch(paths, mask):
+    """Return a non-blocking inotify file descriptor watching every path in paths for the events in mask, and a dict of the paths by watch descriptor. Return None and an empty dict if inotify is unavailable or any path can't be watched."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True) # Get the C library we are linked against
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC) # Create a non-blocking inotify instance
+
+    except (OSError, AttributeError): # If there is no inotify
+        return None, {}
+
+    if fd < 0: # If creating the instance failed
+        return None, {}
+
+    watchedPaths = {} # A dict of the watched paths by watch descriptor
+    for path in paths: # For every path to watch
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), mask) # Watch it (following symlinks)
+        if wd < 0: # If we can't (most likely we lack permission)
+            os.close(fd)
+            return None, {}
+
+        watchedPaths[wd] = path
+
+    return fd, watchedPaths
+
+def watchLayerDir():
+    """Watch layerDir with inotify so compiled layers are forgotten when a layer file changes, instead of stating the file on every keypress. Leave layerWatchFd None if inotify is unavailable."""
+    global layerWatchFd # Globalize layerWatchFd
+
+    fd, watchedPaths = inotifyWatch([layerDir], inotifyFlags) # Try to watch layerDir
+    if fd == None: # If we can't
+        dprint("Can't watch " + layerDir + ", layer files will be stated")
+        return
+
+    layerWatchFd = fd # Store our inotify file descriptor
+    layerCache.clear() # Forget layers compiled under mtime keys
+    deviceSelector.register(fd, selectors.EVENT_READ, None) # Wake the main loop when a layer file changes
+
+def readLayerEvents():
+    """Drain the queued inotify events of layerWatchFd and forget all compiled layers."""
+    try:
+        while os.read(layerWatchFd, 4096): # Read all the queued events, we don't need to know which file changed since layers are cheap to compile
+            pass
+
+    except BlockingIOError: # Once no more events are available
+        pass
+
+    dprint("Layer files changed, forgetting compiled layers")
+    layerCache.clear() # Recompile layers the next time they are used
+
+def compileLayer(filename): # Parse every binding in a layer into a dict of keycodes and actions, an action is a callable taking the macroDevice to run on, and a set of the histories that are the start of a longer binding
+    layerTable = {}
+
+    layerJson = readJson(filename) # Read the layer once
+    layerVars = layerJson.get("vars", {}) # And get its vars for every binding to share
+
+    for keycode, value in layerJson.items(): # For every binding in the layer
+        if keycode in ("leds", "vars"): # Skip the non-binding properties
+            continue
+
+        keycode = sys.intern(keycode) # Intern the keycode so lookups with our interned histories match by identity
+
+        value = parseVars(value, layerVars) # Parse any varables that may appear in the command
+        if value == "": # If the command could not be parsed
+            continue # Leave the keycode unbound
+
+        if value.startswith("layer:"): # If value is a layerswitch command
+            layerTable[keycode] = functools.partial(macroDevice.switchLayer, layer=value.split(':')[-1] + ".json") # Bind a switch to the target layer file
+            continue
+
+        wait = False # Commands run in the background by default
+        if value.startswith("sync:"): # If the user asked for the command to run in the foreground
+            value = value[len("sync:"):] # Strip the prefix
+            wait = True # And store that we should wait
+
+        scriptType, separator, scriptName = value.partition(":") # Split off what may be a script type prefix
+        if separator == ":" and scriptType in scriptTypes: # If value is one of our script types
+            message = f"Executing {scriptTypes[scriptType]}script {scriptName}" # Prepare to notify the user we re running a script
+            value = scriptTypes[scriptType] + scriptDir + scriptName # Set value to executable format
+
+        else: # If this is not a script (i.e. it is a shell command)
+            message = keycode + ": " + value # Prepare to notify the user of the command
+
+        if shellCharRe.search(value) == None and not value.strip() == "": # If the command uses no shell features
+            argv = value.split() # Split it into arguments ourselves and run it without a shell
+
+        else:
+            argv = ["/bin/sh", "-c", value] # Have /bin/sh interpret it
+
+        layerTable[keycode] = functools.partial(macroDevice.runCommand, argv=argv, message=message, wait=wait) # Bind the fully resolved command
+
+    layerPrefixes = set() # A set of the histories that more key peaks could turn into a binding
+    for keycode in layerTable: # For every bound keycode
+        peaks = keycode.split("-") # Split it into its key peaks
+        for peakCount in range(1, len(peaks)): # For every shorter run of its peaks
+            layerPrefixes.add("-".join(peaks[:peakCount])) # Store that history as a prefix
+
+    return layerTable, layerPrefixes
+
+def loadLayer(filename): # Return the compiled bindings and binding prefixes of a layer, only re-parsing the layer file when it has been modified
+    if layerWatchFd == None: # If we aren't being told when layers change
+        cacheKey = (filename, os.stat(layerDir + filename).st_mtime_ns) # Key the cache on the file's modification time so edits are picked up
+
+    else:
+        cacheKey = (filename, None) # readLayerEvents() will clear the cache when the file changes
+
+    if not cacheKey in layerCache: # If we haven't compiled this version of the layer
+        for staleKey in [key for key in layerCache if key[0] == filename]: # For older versions of the layer
+            layerCache.pop(staleKey) # Forget them
+
+        layerCache[cacheKey] = compileLayer(filename) # Compile the layer
+
+    return layerCache[cacheKey]
 
 
 
 # Settings file
 
-settings = { # A dict of settings to be used across the script
-    "multiKeyMode": "combination",
-    "forceBackground": False,
-    "backgroundInversion": False,
-	"loopDelay": 0.0167,
-    "holdThreshold": 1,
-    "flushTimeout": 0.5,
-}
+class settingsNamespace():
+    """A class holding the settings used across the script as attributes."""
+    __slots__ = ("multiKeyMode", "loopDelay", "holdThreshold", "flushTimeout") # Fixed attribute slots are faster to read than dict keys
+
+    def __init__(self):
+        self.multiKeyMode = "combination" # Default values for all settings
+        self.loopDelay = 0.0167
+        self.holdThreshold = 1.0
+        self.flushTimeout = 0.5
+
+    def items(self):
+        """Return a list of (name, value) pairs for all settings."""
+        return [(setting, getattr(self, setting)) for setting in self.__slots__]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+settings = settingsNamespace() # The settings to be used across the script
 
 settingsPossible = { # A dict of lists of valid values for each setting (or if first element is type then list of acceptable types in descending priority)
     "multiKeyMode": ["combination", "sequence"],
-    "forceBackground": [True, False],
-    "backgroundInversion": [True, False],
 	"loopDelay": [type, float, int],
     "holdThreshold": [type, float, int],
     "flushTimeout": [type, float, int],
 }
 
+settingParser = {setting: possible[1] for setting, possible in settingsPossible.items() if possible[0] is type} # A dict of the highest priority type to cast user input to for each typed setting
+
+settingsMtime = None # The modification time of the settings file our settings were last loaded from
+
 def getSettings(): # Reads the json file specified on the third line of config and sets the values of settings based on it's contents
+    global settingsMtime
+
+    mtime = os.stat(dataDir + "settings.json").st_mtime_ns # Get when the settings file was last modified
+    if mtime == settingsMtime: # If it hasn't changed since we last loaded it
+        dprint("Settings unchanged") # Our settings are already up to date
+        return
+
     dprint(f"Loading settings from {dataDir}/settings.json") # Notify the user we are getting settings and tell them the file we are using to do so
 
     settingsFile = readJson("settings.json", dataDir) # Get a dict of the keys and values in our settings file
-    for setting in settings.keys(): # For every setting we expect to be in our settings file
-        if type == settingsPossible[setting][0]: # If first element is type
+    for setting, value in settings.items(): # For every setting we expect to be in our settings file
+        if setting in settingParser: # If first element of settingsPossible is type
             if type(settingsFile[setting]) in settingsPossible[setting]: # If the value in our settings file is valid
                 dprint(f"Found valid typed value: \"{type(settingsFile[setting])}\" for setting: \"{setting}\"")
-                settings[setting] = settingsFile[setting] # Write it into our settings
+                setattr(settings, setting, settingParser[setting](settingsFile[setting])) # Write it into our settings, cast to the setting's first type so the hot loop always compares like types
             else :
-                print(f"Value: \"{settingsFile[setting]}\" for setting: \"{setting}\" is of invalid type, defaulting to {settings[setting]}") # Warn the user of invalid settings in the settings file
+                print(f"Value: \"{settingsFile[setting]}\" for setting: \"{setting}\" is of invalid type, defaulting to {value}") # Warn the user of invalid settings in the settings file
         else:
             if settingsFile[setting] in settingsPossible[setting]: # If the value in our settings file is valid
                 dprint(f"Found valid value: \"{settingsFile[setting]}\" for setting: \"{setting}\"")
-                settings[setting] = settingsFile[setting] # Write it into our settings
+                setattr(settings, setting, settingsFile[setting]) # Write it into our settings
             else :
-                print(f"Value: \"{settingsFile[setting]}\" for setting: \"{setting}\" is invalid, defaulting to {settings[setting]}") # Warn the user of invalid settings in the settings file
+                print(f"Value: \"{settingsFile[setting]}\" for setting: \"{setting}\" is invalid, defaulting to {value}") # Warn the user of invalid settings in the settings file
 
+    settingsMtime = mtime # Remember which version of the file we loaded
     dprint(f"Settings are {settings}") # Debug info
 
 
 
 # Keypress processing
 
-def parseVars(commandStr, layer): # Given a command from the layer json file replace vars with their values and return the string
-    # Vars we will need in the loop
-    returnStr = "" # The string to be retuned
-    escaped = False # If we previously encountered an escape char
-    escapeChar = "\\" # What is out escape char
-    varChars = ("%", "%") # What characters start and end a varable name
-    inVar = False # If we are in a varable name
-    varName = "" # What the varables name is so far
-
-    for char in commandStr : # Iterate over the cars of the input
-        if escaped == True : # If char is escaped add it unconditionally and reset escaped
-            returnStr += char
-            escaped = False
-            continue
-
-        if escaped == False and char == escapeChar : # If char is en unescaped escape char set escaped
-            escaped = True
-            continue
-
-        if inVar == False and char == varChars[0] : # If we arn't in a varable and chars is the start of one set inVar
-            inVar = True
-            continue
-
-        if inVar == True and char == varChars[1] : # If we are in a varable and char ends it parse the varables value, add it to returnStr if valid, and reset inVar and varName
-            try :
-                returnStr += readJson(layer)["vars"][varName]
-            except KeyError :
-                print(f"unknown var {varName} in command {commandStr}, skiping command")
-                return ""
+varRe = re.compile(r"\\(.)|%([^%]*)%", re.DOTALL) # A regex matching either an escaped char or a varable name between "%"s
 
-            inVar = False
-            varName = ""
-            continue
+def parseVars(commandStr, layerVars): # Given a command from a layer json file and that layer's dict of vars replace vars with their values and return the string
+    if not "%" in commandStr and not "\\" in commandStr: # If there is nothing to substitute
+        return commandStr # Skip running the regex
 
-        if inVar == True : # If we are in a varable name add char to varName
-            varName += char
-            continue
+    def replaceMatch(match): # Return the replacement for an escaped char or a varable
+        escapedChar, varName = match.groups()
+        if not escapedChar == None: # If char is escaped add it unconditionally
+            return escapedChar
 
-        returnStr += char # If none of the above (because we use continue) add char to returnStr
+        return layerVars[varName] # Otherwise add the varables value, raises KeyError if the var is unknown
 
-    return returnStr # All done, return the result
+    try :
+        return varRe.sub(replaceMatch, commandStr) # Substitute all escaped chars and vars in one pass
+    except KeyError as error :
+        print(f"unknown var {error.args[0]} in command {commandStr}, skiping command")
+        return ""
 
 def getHistory(): # Return the first key history we get from any of our devices
     clearDeviceLedgers() # Clear all device ledgers
     
-    while readDevices(False) == False: # Read events until a history is flushed
-        time.sleep(settings["loopDelay"]) # Sleep so we don't eat the poor little CPU
+    while readDevices(False) == False: # Wait for and read events until a history is flushed
+        pass
     
     return popDeviceHistories()[0] # Store the first history
 
@@ -653,30 +1219,57 @@ def getHistory(): # Return the first key history we get from any of our devices
 
 # Shells
 
+def parseIntList(text):
+    """Return a list of ints from a comma and/or space separated string, raising ValueError if an item isn't an int."""
+    return [int(item) for item in text.replace(",", " ").split()] # Commas become spaces so a single split handles both separators
+
 def getLayers(): # Lists all the json files in /layers and thier contents
     print("Available Layers: \n")
-    layerFt = ".json"
-    layerFi = {}
-    layers = [i for i in os.listdir(layerDir) if os.path.splitext(i)[1] == layerFt] # Get a list of paths to all files that match our file extension
 
-    for f in layers:
-        with open(os.path.join(layerDir,f)) as file_object:
-            layerFi[f] = file_object.read() # Build a list of the files at those paths
-    
-    for i in layerFi:
-        print(i+layerFi[i]) # And display thier contents to the user
+    layerTexts = [] # A list of the names and contents of every layer
+    with os.scandir(layerDir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file(): # For every file that matches our file extension
+                with open(entry.path) as file_object:
+                    layerTexts.append(entry.name + file_object.read()) # Collect its name and contents
+
+    print("\n".join(layerTexts)) # And display them all to the user with a single write
     end()
 
 def detectKeyboard(path = "/dev/input/by-id/"): # Detect what file a keypress is coming from
-    print("Gaining sudo to watch root owned files, sudo may prompt you for a password") # Warn the user we need sudo
-    subprocess.run(["sudo", "echo",  "have sudo"]) # Get sudo
+    with os.scandir(path) as entries: # Scan the directory
+        watchPaths = [entry.path for entry in entries] # Get a list of paths to watch
+
+    watchFd, watchedPaths = inotifyWatch(watchPaths, 0x1) # Try to watch the devices for reads (IN_ACCESS) ourselves, this works if we can read them
+
+    if watchFd == None: # If we can't
+        print("Gaining sudo to watch root owned files, sudo may prompt you for a password") # Warn the user we need sudo
+        subprocess.run(["sudo", "echo",  "have sudo"]) # Get sudo
 
     print("Please press a key on the desired input device...")
     time.sleep(.5) # Small delay to avoid detecting the device you started the script with
-    dev = ""
-    while dev == "": # Wait for this command to output the device name, loops every 1s
-        dev = subprocess.check_output("sudo inotifywatch " + path +"/* -t 1 2>&1 | grep " + path + " | awk 'NF{ print $NF }'", shell=True ).decode('utf-8').strip()
-    return dev
+
+    if watchFd == None: # If we need sudo to watch the devices
+        watcher = subprocess.Popen(["sudo", "inotifywait", "--monitor", "--quiet", "--format", "%w%f", *watchPaths], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) # Watch all the paths with a single long running process, printing the path of each event
+
+        dev = watcher.stdout.readline().strip() # Block until the first event tells us the path of the device
+        watcher.terminate() # Stop watching
+        watcher.wait()
+
+        return dev
+
+    try:
+        while os.read(watchFd, 4096): # Discard the events from before our delay
+            pass
+
+    except BlockingIOError: # Once no more events are available
+        pass
+
+    os.set_blocking(watchFd, True) # Block on our next read
+    buffer = os.read(watchFd, 4096) # Wait for the first event
+    os.close(watchFd) # Stop watching
+
+    return watchedPaths[inotifyEventStruct.unpack_from(buffer)[0]] # Return the path of the watch descriptor that saw the event
 
 def addKey(layer = "default.json", key = None, command = None, keycodeTimeout = 1): # Shell for adding new macros
     if key == None and command == None:
@@ -684,287 +1277,278 @@ def addKey(layer = "default.json", key = None, command = None, keycodeTimeout =
     else:
         relaunch = False
     
-    if command == None:
-        command = input("Enter the command you would like to attribute to a key on your second keyboard \n") # Get the command the user wishs to bind
+    while True: # Loop until the user is done adding macros
+        if command == None:
+            command = input("Enter the command you would like to attribute to a key on your second keyboard \n") # Get the command the user wishs to bind
 
-        if command.startswith("layer:"): # If the user entered a layer switch command
-            if os.path.exists(command.split(':')[-1]+".json") == False: # Check if the layer json file exsits
-                createLayer(command.split(':')[-1]+".json") # If not create it
-                print("Created layer file: " + command.split(':')[-1]+".json") # And notify the user
+            if command.startswith("layer:"): # If the user entered a layer switch command
+                try:
+                    createLayer(command.split(':')[-1]+".json") # Create the layer json file if it doesn't exist
+                    layerCreated = True
+                except FileExistsError: # If it already exists
+                    layerCreated = False
 
-                print("standard LEDs:")
-                for led in standardLeds.items(): # For all LEDs on most boards
-                    print(f"-{led[0]}: {led[1]}") # List it
+                if layerCreated == True: # If we created it
+                    print("Created layer file: " + command.split(':')[-1]+".json") # Notify the user
 
-                onLeds = input("Please choose what LEDs should be enable on this layer (comma and/or space separated list)") # Prompt the user for a list of LED numbers
-                onLeds = onLeds.replace(",", " ").split() # Split the input list
+                    print(standardLedsMenu) # List all LEDs on most boards
 
-                onLedsInt = []
-                for led in onLeds: # For all strs in the split list
-                    onLedsInt.append(int(led)) # Cast the str to int and add it to a list
+                    onLeds = input("Please choose what LEDs should be enable on this layer (comma and/or space separated list)") # Prompt the user for a list of LED numbers
+                    onLedsInt = parseIntList(onLeds) # Split the input list and cast it to ints
 
-                writeJson(command.split(':')[-1]+".json", {"leds": onLedsInt}) # Write the input list to the layer file
+                    writeJson(command.split(':')[-1]+".json", {"leds": onLedsInt}) # Write the input list to the layer file
 
-    if key == None:
-        print(f"Please the execute keystrokes you would like to assign the command to and wait for the next prompt.")
-        key = getHistory()
+        if key == None:
+            print("Please the execute keystrokes you would like to assign the command to and wait for the next prompt.")
+            key = getHistory()
 
-    inp = input(f"Assign {command} to [{key}]? [Y/n] ") # Ask the user if we (and they) got the command and binding right
-    if inp == 'Y' or inp == '': # If we did 
-        newMacro = {}
-        newMacro[key] = command
-        writeJson(layer, newMacro) # Write the binding into our layer json file
-        print(newMacro) # And print it back
+        inp = input(f"Assign {command} to [{key}]? [Y/n] ") # Ask the user if we (and they) got the command and binding right
+        if inp == 'Y' or inp == '': # If we did 
+            newMacro = {}
+            newMacro[key] = command
+            writeJson(layer, newMacro) # Write the binding into our layer json file
+            print(newMacro) # And print it back
 
-    else: # If we didn't
-        print("Addition cancelled.") # Confirm we have cancelled the binding
+        else: # If we didn't
+            print("Addition cancelled.") # Confirm we have cancelled the binding
+
+        if relaunch == False: # If we were launched to change a single binding
+            return # Hand control back to our caller
 
-    if relaunch:
         rep = input("Would you like to add another Macro? [Y/n] ") # Offer the user to add another binding
 
         if rep == 'Y' or rep == '': # If they say yes
-            addKey(layer) # Restart the shell
+            key = None # Forget the last binding
+            command = None
+            continue # And restart the shell
 
-        end()
+        break # Otherwise leave the shell
+
+    end()
 
 def editSettings(): # Shell for editing settings
-    settingsFile = readJson("settings.json", dataDir) # Get a dict of the keys and values in our settings file
-    
-    settingsList = [] # Create a list for key-value pairs of settings 
-    for setting in settings.items(): # For every key-value pair in our settings dict
-        settingsList += [setting, ] # Add the pair to our list of seting pairs
+    while True: # Loop until the user is done editing settings
+        settingsList = list(settings.items()) # Create a list of the key-value pairs of our settings
 
-    print("Choose what value you would like to edit.") # Ask the user to choose which setting they wish to edit
-    for settingIndex in range(0, len(settingsList)): # For the index number of every setting pair in our list of setting pairs
-        print(f"-{settingIndex + 1}: {settingsList[settingIndex][0]}   [{settingsList[settingIndex][1]}]") # Print an entry for every setting, as well as a number associated with it and it's current value
+        print("Choose what value you would like to edit.") # Ask the user to choose which setting they wish to edit
+        print("\n".join(f"-{settingIndex + 1}: {setting}   [{value}]" for settingIndex, (setting, value) in enumerate(settingsList))) # Print an entry for every setting, as well as a number associated with it and it's current value, with a single write
     
-    selection = input("Please make you selection: ") # Take the users input as to which setting they wish to edit
+        selection = input("Please make you selection: ") # Take the users input as to which setting they wish to edit
     
-    try: # Try to...
-        intSelection = int(selection) # Convert the users input from str to int
+        try: # Try to...
+            intSelection = int(selection) # Convert the users input from str to int
     
-    except ValueError: # If the conversion to int fails
-        print("Exiting...") # Tell the user we are exiting
-        end() # And do so
+        except ValueError: # If the conversion to int fails
+            print("Exiting...") # Tell the user we are exiting
+            end() # And do so
 
-    if intSelection in range(1, len(settingsList) + 1): # If the users input corresponds to a listed setting
-        settingSelected = settingsList[int(selection) - 1][0] # Store the selected setting's name
-        print(f"Editing item \"{settingSelected}\"") # Tell the user we are thier selection
+        if intSelection in range(1, len(settingsList) + 1): # If the users input corresponds to a listed setting
+            settingSelected = settingsList[intSelection - 1][0] # Store the selected setting's name
+            print(f"Editing item \"{settingSelected}\"") # Tell the user we are thier selection
     
-    else: # If the users input does not correspond to a listed setting
-        print("Input out of range, exiting...") # Tell the user we are exiting
-        end() # And do so
-
-    if type == settingsPossible[settingSelected][0]: # If first element of settingsPossible is type
-        print(f"Enter a value {settingSelected} that is of one of these types.")
-        for valueIndex in range(1, len(settingsPossible[settingSelected])): # For the index number of every valid type of the users selected setting
-            print("- " + settingsPossible[settingSelected][valueIndex].__name__) # Print an entry for every valid type
+        else: # If the users input does not correspond to a listed setting
+            print("Input out of range, exiting...") # Tell the user we are exiting
+            end() # And do so
+
+        if settingSelected in settingParser: # If first element of settingsPossible is type
+            print(f"Enter a value {settingSelected} that is of one of these types.")
+            for valueIndex in range(1, len(settingsPossible[settingSelected])): # For the index number of every valid type of the users selected setting
+                print("- " + settingsPossible[settingSelected][valueIndex].__name__) # Print an entry for every valid type
             
-        selection = input("Please enter a value: ") # Prompt the user for input
+            selection = input("Please enter a value: ") # Prompt the user for input
 
-        if selection == "": # If none is provided
-            print("Exiting...")
-            end() # Exit
+            if selection == "": # If none is provided
+                print("Exiting...")
+                end() # Exit
 
-        for typePossible in settingsPossible[settingSelected]: # For all valid types
-            dprint(typePossible)
-            if typePossible == type: # If it is type
-                continue
             try: # Try to...
-                selection = typePossible(selection) # Cast the users input to the type
-                break
+                selection = settingParser[settingSelected](selection) # Cast the users input to the setting's type
             except ValueError: # If casting fails
-                pass
-        
-        if type(selection) in settingsPossible[settingSelected]: # If we have successfully casted to a valid type
+                print("Input can't be casted to a supported type, exiting...") # Complain about the bad input
+                end() # And exit
+
             writeJson("settings.json", {settingSelected: selection}, dataDir) # Write the setting into the settings file
             print(f"Set \"{settingSelected}\" to \"{selection}\"")
+
         else:
-            print("Input can't be casted to a supported type, exiting...") # Complain about the bad input
-            end() # And exit
+            print(f"Choose one of {settingSelected}\'s possible values.") # Ask the user to choose which value they want to assign to their selected setting
+            valueLines = [] # A list of menu entries for the valid values
+            for valueIndex in range(0, len(settingsPossible[settingSelected])): # For the index number of every valid value of the users selected setting
+                valueLine = f"-{valueIndex + 1}: {settingsPossible[settingSelected][valueIndex]}" # Make an entry for every valid value, as well as a number associated with it
+                if settingsPossible[settingSelected][valueIndex] == getattr(settings, settingSelected): # If a value is the current value of the selected setting
+                    valueLine += "   [current]" # Tell the user
 
-    else:
-        print(f"Choose one of {settingSelected}\'s possible values.") # Ask the user to choose which value they want to assign to their selected setting
-        for valueIndex in range(0, len(settingsPossible[settingSelected])): # For the index number of every valid value of the users selected setting
-            print(f"-{valueIndex + 1}: {settingsPossible[settingSelected][valueIndex]}", end = "") # Print an entry for every valid value, as well as a number associate, with no newline
-            if settingsPossible[settingSelected][valueIndex] == settings[settingSelected]: # If a value is the current value of the selected setting
-                print("   [current]") # Tell the user and add a newline
+                valueLines.append(valueLine)
 
-            else:
-                print() # Add a newline
+            print("\n".join(valueLines)) # Print all the entries with a single write
 
-        selection = input("Please make you selection: ") # Take the users input as to which value they want to assign to their selected setting
+            selection = input("Please make you selection: ") # Take the users input as to which value they want to assign to their selected setting
 
-        try: # Try to...
-            intSelection = int(selection) # Convert the users input from str to int
-            if intSelection in range(1, len(settingsPossible[settingSelected]) + 1): # If the users input corresponds to a listed value
-                valueSelected = settingsPossible[settingSelected][int(selection) - 1] # Store the selected value
-                writeJson("settings.json", {settingSelected: valueSelected}, dataDir) # Write it into our settings json file
-                print(f"Set \"{settingSelected}\" to \"{valueSelected}\"") # And tell the user we have done so
+            try: # Try to...
+                intSelection = int(selection) # Convert the users input from str to int
+                if intSelection in range(1, len(settingsPossible[settingSelected]) + 1): # If the users input corresponds to a listed value
+                    valueSelected = settingsPossible[settingSelected][intSelection - 1] # Store the selected value
+                    writeJson("settings.json", {settingSelected: valueSelected}, dataDir) # Write it into our settings json file
+                    print(f"Set \"{settingSelected}\" to \"{valueSelected}\"") # And tell the user we have done so
             
-            else: # If the users input does not correspond to a listed value
-                print("Input out of range, exiting...") # Tell the user we are exiting
+                else: # If the users input does not correspond to a listed value
+                    print("Input out of range, exiting...") # Tell the user we are exiting
+                    end() # And do so
+
+            except ValueError: # If the conversion to int fails
+                print("Exiting...") # Tell the user we are exiting
                 end() # And do so
 
-        except ValueError: # If the conversion to int fails
-            print("Exiting...") # Tell the user we are exiting
-            end() # And do so
+        getSettings() # Refresh the settings in our settings dict with the newly changed setting
 
-    getSettings() # Refresh the settings in our settings dict with the newly changed setting
+        rep = input("Would you like to change another setting? [Y/n] ") # Offer the user to edit another setting
 
-    rep = input("Would you like to change another setting? [Y/n] ") # Offer the user to edit another setting
+        if rep == 'Y' or rep == '': # If they say yes
+            continue # Restart the shell
 
-    if rep == 'Y' or rep == '': # If they say yes
-        editSettings() # Restart the shell
+        break # Otherwise leave the shell
 
-    else:
-        end()
+    end()
 
 def editLayer(layer = "default.json"): # Shell for editing a layer file (default by default)
-    LayerDict = readJson(layer, layerDir) # Get a dict of keybindings in the layer file
+    while True: # Loop until the user is done editing bindings
+        LayerDict = readJson(layer, layerDir) # Get a dict of keybindings in the layer file
     
-    keybindingsList = [] # Create a list for key-value pairs of keybindings
-    for keybinding in LayerDict.items(): # For every key-value pair in our layers dict
-        keybindingsList += [keybinding, ] # Add the pair to our list of keybinding pairs
-
-    print("Choose what binding you would like to edit.") # Ask the user to choose which keybinding they wish to edit
-    for bindingIndex in range(0, len(keybindingsList)): # For the index number of every binding pair in our list of binding pairs
-        if keybindingsList[bindingIndex][0] == "leds":
-            print(f"-{bindingIndex + 1}: Edit LEDs")
-        elif keybindingsList[bindingIndex][0] == "vars":
-            print(f"-{bindingIndex + 1}: Edit layer varables")
-        else:
-            print(f"-{bindingIndex + 1}: {keybindingsList[bindingIndex][0]}   [{keybindingsList[bindingIndex][1]}]") # Print an entry for every binding, as well as a number associated with it and it's current value
+        keybindingsList = list(LayerDict.items()) # Create a list of the key-value pairs of keybindings in our layers dict
+
+        print("Choose what binding you would like to edit.") # Ask the user to choose which keybinding they wish to edit
+        bindingLines = [] # A list of menu entries for the bindings
+        for bindingIndex in range(0, len(keybindingsList)): # For the index number of every binding pair in our list of binding pairs
+            if keybindingsList[bindingIndex][0] == "leds":
+                bindingLines.append(f"-{bindingIndex + 1}: Edit LEDs")
+            elif keybindingsList[bindingIndex][0] == "vars":
+                bindingLines.append(f"-{bindingIndex + 1}: Edit layer varables")
+            else:
+                bindingLines.append(f"-{bindingIndex + 1}: {keybindingsList[bindingIndex][0]}   [{keybindingsList[bindingIndex][1]}]") # Make an entry for every binding, as well as a number associated with it and it's current value
+
+        print("\n".join(bindingLines)) # Print all the entries with a single write
     
-    selection = input("Please make you selection: ") # Take the users input as to which binding they wish to edit
+        selection = input("Please make you selection: ") # Take the users input as to which binding they wish to edit
     
-    try: # Try to...
-        intSelection = int(selection) # Comvert the users input from str to int
-        if intSelection in range(1, len(keybindingsList) + 1): # If the users input corresponds to a listed binding
-            bindingSelected = keybindingsList[int(selection) - 1][0] # Store the selected bindings's key
-            print(f"Editing item \"{bindingSelected}\"") # Tell the user we are editing their selection
+        try: # Try to...
+            intSelection = int(selection) # Comvert the users input from str to int
+            if intSelection in range(1, len(keybindingsList) + 1): # If the users input corresponds to a listed binding
+                bindingSelected = keybindingsList[intSelection - 1][0] # Store the selected bindings's key
+                print(f"Editing item \"{bindingSelected}\"") # Tell the user we are editing their selection
         
-        else: # If the users input does not correspond to a listed binding
-            print("Input out of range, exiting...") # Tell the user we are exiting
-            end() # And do so
-
-    except ValueError: # If the conversion to int fails
-        print("Exiting...") # Tell the user we are exiting
-        end() # And do so
+            else: # If the users input does not correspond to a listed binding
+                print("Input out of range, exiting...") # Tell the user we are exiting
+                end() # And do so
 
-    if bindingSelected == "leds":
-        print("standard LEDs:")
-        for led in standardLeds.items(): # For all LEDs on most boards
-            print(f"-{led[0]}: {led[1]}") # List it
+        except ValueError: # If the conversion to int fails
+            print("Exiting...") # Tell the user we are exiting
+            end() # And do so
 
-        onLeds = input("Please choose what LEDs should be enable on this layer (comma and/or space separated list)") # Prompt the user for a list of LED numbers
-        onLeds = onLeds.replace(",", " ").split() # Split the input list
+        if bindingSelected == "leds":
+            print(standardLedsMenu) # List all LEDs on most boards
 
-        onLedsInt = []
-        for led in onLeds: # For all strs in the split list
-            onLedsInt.append(int(led)) # Cast the str to int and add it to a list
+            onLeds = input("Please choose what LEDs should be enable on this layer (comma and/or space separated list)") # Prompt the user for a list of LED numbers
+            onLedsInt = parseIntList(onLeds) # Split the input list and cast it to ints
 
-        writeJson(layer, {"leds": onLedsInt}) # Write the input list to the layer file
+            writeJson(layer, {"leds": onLedsInt}) # Write the input list to the layer file
 
-    elif bindingSelected == "vars":
-        varsDict = readJson(layer, layerDir)["vars"] # Get a dict of layer vars in the layer file
+        elif bindingSelected == "vars":
+            varsDict = LayerDict.get("vars", {}) # Get the dict of layer vars from the layer file we already read
         
-        varsList = [] # Create a list for key-value pairs of layer vars
-        for var in varsDict.items(): # For every key-value pair in our layer vars dict
-            varsList += [var, ] # Add the pair to our list of layer var pairs
+            varsList = list(varsDict.items()) # Create a list of the key-value pairs of layer vars in our layer vars dict
 
-        print("Choose what varable you would like to edit.") # Ask the user to choose which var they wish to edit
-        for varIndex in range(0, len(varsList)): # For the index number of every var pair in our list of var pairs
-            print(f"-{varIndex + 1}: {varsList[varIndex][0]}   [{varsList[varIndex][1]}]")
+            print("Choose what varable you would like to edit.") # Ask the user to choose which var they wish to edit
+            print("\n".join(f"-{varIndex + 1}: {var}   [{value}]" for varIndex, (var, value) in enumerate(varsList))) # Print an entry for every var pair with a single write
             
-        selection = input("Please make you selection: ") # Take the users input as to which var they wish to edit
+            selection = input("Please make you selection: ") # Take the users input as to which var they wish to edit
     
-        try: # Try to...
-            intSelection = int(selection) # Comvert the users input from str to int
-            if intSelection in range(1, len(varsList) + 1): # If the users input corresponds to a listed var
-                varSelected = varsList[int(selection) - 1][0] # Store the selected var's key
-                print(f"Editing item \"{varSelected}\"") # Tell the user we are editing their selection
+            try: # Try to...
+                intSelection = int(selection) # Comvert the users input from str to int
+                if intSelection in range(1, len(varsList) + 1): # If the users input corresponds to a listed var
+                    varSelected = varsList[intSelection - 1][0] # Store the selected var's key
+                    print(f"Editing item \"{varSelected}\"") # Tell the user we are editing their selection
             
-            else: # If the users input does not correspond to a listed var
-                print("Input out of range, exiting...") # Tell the user we are exiting
-                end() # And do so
+                else: # If the users input does not correspond to a listed var
+                    print("Input out of range, exiting...") # Tell the user we are exiting
+                    end() # And do so
 
-        except ValueError: # If the conversion to int fails
-            print("Exiting...") # Tell the user we are exiting
-            end() # And do so
+            except ValueError: # If the conversion to int fails
+                print("Exiting...") # Tell the user we are exiting
+                end() # And do so
 
-        print(f"Choose am action to take on {varSelected}.") # Ask the user to choose what they want to do with their selected var
-        # Prompt the user with a few possible actions
-        print("-1: Delete varable.")
-        print("-2: Edit varable name.")
-        print("-3: Edit varable value.")
-        print("-4: Cancel.")
+            print(f"Choose am action to take on {varSelected}.") # Ask the user to choose what they want to do with their selected var
+            # Prompt the user with a few possible actions
+            print("-1: Delete varable.")
+            print("-2: Edit varable name.")
+            print("-3: Edit varable value.")
+            print("-4: Cancel.")
 
-        selection = input("Please make you selection: ") # Take the users input as to what they want to do with their selected var
+            selection = input("Please make you selection: ") # Take the users input as to what they want to do with their selected var
 
-        try: # Try to...
-            intSelection = int(selection) # Convert the users input from str to int
-
-            if intSelection == 1: # If the user selected delete
-                popJson(layer, ["vars", varSelected]) # Remove the var
-            elif intSelection == 2: # If the user selected edit name
-                varName = input("Please input new name: ") # Ask the user for a new name
-                varsDict.update({varName: varsDict[varSelected]}) # Add new name and value to varDict
-                writeJson(layer, {"vars": varsDict}) # Set layer's vars to varDict
-                popJson(layer, ["vars", varSelected]) # Note: if the user replaces the original name with the same name this will delete the binding
-            elif intSelection == 3: # If the user selected edit value
-                varVal = input("Please input new value: ") # Ask the user for a new value
-                varsDict.update({varSelected: varVal}) # Update name to new value in varDict
-                writeJson(layer, {"vars": varsDict}) # Set layer's vars to varDict
-            elif intSelection == 4: # If the user selected cancel
-                pass # Pass back to the previous level
-
-            else: # If the users input does not correspond to a listed value
-                print("Input out of range, exiting...") # Tell the user we are exiting
+            try: # Try to...
+                intSelection = int(selection) # Convert the users input from str to int
+
+                if intSelection == 1: # If the user selected delete
+                    popJson(layer, ["vars", varSelected]) # Remove the var
+                elif intSelection == 2: # If the user selected edit name
+                    varName = input("Please input new name: ") # Ask the user for a new name
+                    varsDict.update({varName: varsDict[varSelected]}) # Add new name and value to varDict
+                    writeJson(layer, {"vars": varsDict}) # Set layer's vars to varDict
+                    popJson(layer, ["vars", varSelected]) # Note: if the user replaces the original name with the same name this will delete the binding
+                elif intSelection == 3: # If the user selected edit value
+                    varVal = input("Please input new value: ") # Ask the user for a new value
+                    varsDict.update({varSelected: varVal}) # Update name to new value in varDict
+                    writeJson(layer, {"vars": varsDict}) # Set layer's vars to varDict
+                elif intSelection == 4: # If the user selected cancel
+                    pass # Pass back to the previous level
+
+                else: # If the users input does not correspond to a listed value
+                    print("Input out of range, exiting...") # Tell the user we are exiting
+                    end() # And do so
+
+            except ValueError: # If the conversion to int fails
+                print("Exiting...") # Tell the user we are exiting
                 end() # And do so
 
-        except ValueError: # If the conversion to int fails
-            print("Exiting...") # Tell the user we are exiting
-            end() # And do so
-
-    else:
-        print(f"Choose am action to take on {bindingSelected}.") # Ask the user to choose what they want to do with their selected binding
-        # Prompt the user with a few possible actions
-        print("-1: Delete binding.")
-        print("-2: Edit binding key.")
-        print("-3: Edit binding command.")
-        print("-4: Cancel.")
-
-        selection = input("Please make you selection: ") # Take the users input as to what they want to do with their selected binding
+        else:
+            print(f"Choose am action to take on {bindingSelected}.") # Ask the user to choose what they want to do with their selected binding
+            # Prompt the user with a few possible actions
+            print("-1: Delete binding.")
+            print("-2: Edit binding key.")
+            print("-3: Edit binding command.")
+            print("-4: Cancel.")
 
-        try: # Try to...
-            intSelection = int(selection) # Convert the users input from str to int
+            selection = input("Please make you selection: ") # Take the users input as to what they want to do with their selected binding
 
-            if intSelection == 1: # If the user selected delete
-                popJson(layer, bindingSelected) # Remove the binding
-            elif intSelection == 2: # If the user selected edit key
-                addKey(layer, command = LayerDict[bindingSelected]) # Launch the key addition shell and preserve the command
-                popJson(layer, bindingSelected) # Note: if the user replaces the original key with the same key this will delete the binding
-            elif intSelection == 3: # If the user selected edit command
-                addKey(layer, key = bindingSelected) # Launch the key addition shell and preserve the key
-            elif intSelection == 4: # If the user selected cancel
-                pass # Pass back to the previous level
-
-            else: # If the users input does not correspond to a listed value
-                print("Input out of range, exiting...") # Tell the user we are exiting
+            try: # Try to...
+                intSelection = int(selection) # Convert the users input from str to int
+
+                if intSelection == 1: # If the user selected delete
+                    popJson(layer, bindingSelected) # Remove the binding
+                elif intSelection == 2: # If the user selected edit key
+                    addKey(layer, command = LayerDict[bindingSelected]) # Launch the key addition shell and preserve the command
+                    popJson(layer, bindingSelected) # Note: if the user replaces the original key with the same key this will delete the binding
+                elif intSelection == 3: # If the user selected edit command
+                    addKey(layer, key = bindingSelected) # Launch the key addition shell and preserve the key
+                elif intSelection == 4: # If the user selected cancel
+                    pass # Pass back to the previous level
+
+                else: # If the users input does not correspond to a listed value
+                    print("Input out of range, exiting...") # Tell the user we are exiting
+                    end() # And do so
+
+            except ValueError: # If the conversion to int fails
+                print("Exiting...") # Tell the user we are exiting
                 end() # And do so
 
-        except ValueError: # If the conversion to int fails
-            print("Exiting...") # Tell the user we are exiting
-            end() # And do so
+        rep = input("Would you like to edit another binding? [Y/n] ") # Offer the user to edit another binding
 
-    rep = input("Would you like to edit another binding? [Y/n] ") # Offer the user to edit another binding
+        if rep == 'Y' or rep == '': # If they say yes
+            continue # Restart the shell
 
-    if rep == 'Y' or rep == '': # If they say yes
-        editLayer(layer) # Restart the shell
+        break # Otherwise leave the shell
 
-    else:
-        end()
+    end()
 
 def newDevice(eventPath = "/dev/input/"):
     """Add a new json file to devices/."""
@@ -975,8 +1559,10 @@ def newDevice(eventPath = "/dev/input/"):
     if initialLayer.strip() == "": # If the user did not provide a layer name
         initialLayer = "default.json" # Default to default.json
 
-    if os.path.exists(layerDir + initialLayer) == False: # If the users chosen layer does not exist
-        createLayer(initialLayer) # Create it
+    try:
+        createLayer(initialLayer) # Create the users chosen layer if it does not exist
+    except FileExistsError: # If it already exists
+        pass
 
     eventFile = detectKeyboard(eventPath) # Prompt the user for a device
     eventFile = os.path.basename(eventFile) # Get the devices filename from its filepath
@@ -997,23 +1583,24 @@ def newDevice(eventPath = "/dev/input/"):
 
     end()
 
-def removeDevice(name = None):
-    """Removes a device file from deviceDir and udev rule based on passed name. If no name is passed prompt the user to choose one."""
-    if name == None or name == True: # If no name was provided
+def removeDevice(names = None):
+    """Removes device files from deviceDir and thier udev rules based on a passed list of names. If no names are passed prompt the user to choose some."""
+    if names == None or names == []: # If no names were provided
         print("Devices:")
 
-        deviceList = os.listdir(deviceDir) # Get a list of device files
-        for deviceIndex in range(0, len(deviceList)): # For all device files
-            print(f"-{deviceIndex + 1}: {deviceList[deviceIndex]}") # Print thier names
+        with os.scandir(deviceDir) as entries: # Scan deviceDir
+            deviceList = [entry.name for entry in entries if entry.name.endswith(".json") and entry.is_file()] # Get a list of device files
+        print("\n".join(f"-{deviceIndex + 1}: {device}" for deviceIndex, device in enumerate(deviceList))) # Print the names of all device files with a single write
         
-        selection = int(input("Please make your selection : ")) # Prompt the user for a selection
-        name = deviceList[selection - 1] # Set name based on the users selection
+        selections = parseIntList(input("Please make your selection(s) (comma and/or space separated list) : ")) # Prompt the user for one or more selections
+        names = [deviceList[selection - 1] for selection in selections] # Set names based on the users selections
     
-    udevRule = readJson(name, deviceDir)["udev_rule"] # Cache the path to the devices udev rule
+    udevRules = ["/etc/udev/rules.d/" + readJson(name, deviceDir)["udev_rule"] for name in names] # Cache the paths to the devices udev rules
 
-    print("removing device file and udev rule, sudo may prompt you for a password.") # Warn the user we need sudo
-    os.remove(deviceDir + name) # Remove the device file
-    subprocess.run(["sudo", "rm", "-f", "/etc/udev/rules.d/" + udevRule]) # Remove the udev rule
+    print("removing device files and udev rules, sudo may prompt you for a password.") # Warn the user we need sudo
+    for name in names: # For every device
+        os.remove(deviceDir + name) # Remove the device file
+    subprocess.run(["sudo", "rm", "-f", *udevRules]) # Remove all the udev rules with a single sudo call
 
     end()
 
@@ -1027,134 +1614,24 @@ def firstUses(): # Setup to be run when a user first runs keebie
 
 
 
-# Inter-process communication
-
-def savePid():
-    """Save our PID into the PID file. Raise FileExistsError if the PID file already exists."""
-    dprint("Saving PID to " + pidPath)
-
-    global savedPid # Globalize savedPid
-
-    pid = os.getpid() # Get this process' PID
-
-    if os.path.exists(pidPath) == False: # If no PID file already exists
-        with open(pidPath, "wt") as pidFile: # Create and open the PID file
-            pidFile.write(str(pid)) # Write our PID into it
-            savedPid = True # Record that we have saved our PID
-
-    else:
-        dprint("PID already recorded")
-        raise FileExistsError("PID already recorded")
-
-def removePid():
-    """Remove the PID file if it exists."""
-    dprint("Removing PID file " + pidPath)
-
-    global savedPid # Globalize savedPid
-
-    if os.path.exists(pidPath) == True: # If the PID file exists
-        os.remove(pidPath) # Remove it
-        savedPid = False # And record it's removal
-
-    else:
-        print("PID was never stored?")
-
-def getPid():
-    """Return the PID in the PID file. Raise FileNotFoundError if the file does not exist."""
-    if os.path.exists(pidPath) == True: # If the PID file exists
-        with open(pidPath, "rt") as pidFile: # Open it
-            return int(pidFile.read()) # And return it's contents as an int
-
-    else:
-        dprint("PID file dosn't exist")
-        raise FileNotFoundError("PID file dosn't exist")
-
-def checkPid():
-    """Try to get the PID and check if it is valid. Raise FileNotFoundError if the PID file does not exist. Raise ProcessLookupError and remove the PID file if no process has the PID."""
-    pid = getPid() # Try to get the PID in the PID file, this will raise en exception if the file is missing
-
-    try:
-        os.kill(pid, 0) # Send signal 0 to the process, this will raise OSError if the process doesn't exist
-    
-    except OSError:
-        dprint("PID invalid")
-        removePid() # Remove the PID file since its wrong
-        raise ProcessLookupError("PID invalid")
-
-def sendStop():
-    """If a valid PID is found in the PID file send SIGINT to the process."""
-    try:
-        dprint("Sending stop")
-
-        checkPid() # Check if the PID file point's to a valid process
-        
-        os.kill(getPid(), signal.SIGINT) # Stop the process
-
-    except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't valid
-        dprint("No process to stop")
-
-def sendPause(waitSafeTime=None):
-    """If a valid PID is found in the PID file send SIGUSR1 to the process."""
-    try:
-        dprint("Sending pause")
-
-        checkPid() # Check if the PID file point's to a valid process
-
-        global havePaused
-        havePaused = True # Save that we have paused the process
-        
-        os.kill(getPid(), signal.SIGUSR1) # Pause the process
-
-        if waitSafeTime == None:
-            waitSafeTime = settings["loopDelay"] * 3 # Set how long we should wait
-
-        time.sleep(waitSafeTime) # Wait a bit to make sure the process paused itself
-
-    except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't valid
-        dprint("No process to pause")
-
-def sendResume():
-    """If a valid PID is found in the PID file send SIGUSR2 to the process."""
-    try:
-        dprint("Sending resume")
-        
-        checkPid() # Check if the PID file point's to a valid process
-
-        global havePaused
-        havePaused = False # Save that we have resumed the process
-
-        os.kill(getPid(), signal.SIGUSR2) # Resume the process
-
-    except (FileNotFoundError, ProcessLookupError): # If the PID file doesn't exist or the process isn't 
-        dprint("No process to resume")
-
-def pause(signal, frame):
-    """Ungrab all macro devices."""
-    print("Pausing...")
-
-    global paused
-    paused = True # Save that we have been paused)
-
-    ungrabMacroDevices() # Ungrab all devices so the pausing process can use them
-    closeDevices() # Close our macro devices
-
-def resume(signal, frame):
-    """Grab all macro devices and refresh our setting after being paused (or just if some changes were made we need to load)."""
-    print("Resuming...")
-
-    global paused
-    
-    getSettings() # Refresh our settings
+# Arguments
 
-    if paused == True: # If we were paused prior
-        setupMacroDevices() # Set our macro devices up again to detect changes
-        grabMacroDevices() # Grab all our devices back
+def jsonFileArgument(directory):
+    """Return an argparse type function that only accepts the names of json files in directory, so the directory is only listed when the argument is used."""
+    def checkJsonFile(name):
+        try:
+            with os.scandir(directory) as entries: # Scan the directory
+                choices = [entry.name for entry in entries if entry.name.endswith(".json") and entry.is_file()] # Get a list of json files in it
 
-    paused = False # Save that we are no longer paused
+        except FileNotFoundError : # If there are no user configuration files yet
+            return name # Don't restrict the choices
 
+        if not name in choices: # If the user named a file that doesn't exist
+            raise argparse.ArgumentTypeError(f"invalid choice: '{name}' (choose from {', '.join(repr(choice) for choice in choices)})")
 
+        return name
 
-# Arguments
+    return checkJsonFile
 
 parser = argparse.ArgumentParser() # Set up command line arguments
 
@@ -1162,25 +1639,16 @@ parser.add_argument("--layers", "-l", help="Show saved layer files", action="sto
 parser.add_argument("--detect", "-d", help="Detect keyboard device file", action="store_true")
 parser.add_argument("--print-keys", "-k", help="Print a series of keystrokes", action="store_true")
 
-try:
-    parser.add_argument("--add", "-a", help="Adds new macros to the selected layer file (or default layer if unspecified)", nargs="?", default=False, const="default.json", metavar="layer", choices=[i for i in os.listdir(layerDir) if os.path.splitext(i)[1] == ".json"])
-except FileNotFoundError :
-    parser.add_argument("--add", "-a", help="Adds new macros to the selected layer file (or default layer if unspecified)", nargs="?", default=False, const="default.json", metavar="layer")
+parser.add_argument("--add", "-a", help="Adds new macros to the selected layer file (or default layer if unspecified)", nargs="?", default=False, const="default.json", metavar="layer", type=jsonFileArgument(layerDir))
 
 parser.add_argument("--settings", "-s", help="Edits settings file", action="store_true")
 
-try:
-    parser.add_argument("--edit", "-e", help="Edits specified layer file (or default layer if unspecified)", nargs="?", default=False, const="default.json", metavar="layer", choices=[i for i in os.listdir(layerDir) if os.path.splitext(i)[1] == ".json"])
-except FileNotFoundError :
-    parser.add_argument("--edit", "-e", help="Edits specified layer file (or default layer if unspecified)", nargs="?", default=False, const="default.json", metavar="layer")
+parser.add_argument("--edit", "-e", help="Edits specified layer file (or default layer if unspecified)", nargs="?", default=False, const="default.json", metavar="layer", type=jsonFileArgument(layerDir))
 
 parser.add_argument("--new", "-n", help="Add a new device file", action="store_true")
 
-try:
-    parser.add_argument("--remove", "-r", help="Remove specified device, if no device is specified you will be prompted", nargs="?", default=False, const=True, metavar="device", choices=[i for i in os.listdir(deviceDir) if os.path.splitext(i)[1] == ".json"])
-except FileNotFoundError :
-    parser.add_argument("--remove", "-r", help="Remove specified device, if no device is specified you will be prompted", nargs="?", default=False, const=True, metavar="device")
-    
+parser.add_argument("--remove", "-r", help="Remove specified devices, if no device is specified you will be prompted", nargs="*", default=False, metavar="device", type=jsonFileArgument(deviceDir))
+
 parser.add_argument("--pause", "-P", help="Pause a running keebie instance that is processing macros", action="store_true")
 
 parser.add_argument("--resume", "-R", help="Resume a keebie instance paused by --pause", action="store_true")
@@ -1206,32 +1674,36 @@ if not args.print_keys:
     print("Welcome to Keebie")
 
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler) # Exit through end() when asked to terminate too, so cleanUp() runs
 
 if not os.path.exists(dataDir): # If the user we are running as does not have user configuration files
     print("You are running keebie without user configuration files installed") # Inform the user
     firstUses() # Run first time user setup
 
-setupMacroDevices() # Setup all devices
-
-getSettings() # Get settings from the json file in config
-
-
 if args.layers: # If the user passed --layers
     getLayers() # Show the user all layer json files and their contents
 
 elif args.print_keys:
+    getSettings() # Get settings from the json file in config
+    setupMacroDevices() # Setup all devices
+
     sendPause() # Ask a running keebie loop (if one exists) to pause so we can use the devices
     grabMacroDevices()
     print(getHistory()) # Print the first key history we get from any of our devices
     end()
 
 elif args.add: # If the user passed --add
+    getSettings() # Get settings from the json file in config
+    setupMacroDevices() # Setup all devices
+
     sendPause() # Ask a running keebie loop (if one exists) to pause so we can use the devices
 
     grabMacroDevices()
     addKey(args.add) # Launch the key addition shell
 
 elif args.settings: # If the user passed --settings
+    getSettings() # Get settings from the json file in config
+
     sendPause() # Ask a running keebie loop (if one exists) to pause so it will reload its settings when we're done
 
     editSettings() # Launch the setting editing shell
@@ -1240,17 +1712,24 @@ elif args.detect: # If the user passed --detect
     print(detectKeyboard("/dev/input/")) # Launch the keyboard detection function
 
 elif args.edit: # If the user passed --edit
+    getSettings() # Get settings from the json file in config
+    setupMacroDevices() # Setup all devices
+
     sendPause() # Ask a running keebie loop (if one exists) to pause so we can use the devices
 
     grabMacroDevices()
     editLayer(args.edit) # Launch the layer editing shell
 
 elif args.new: # If the user passed --new
+    getSettings() # Get settings from the json file in config
+
     sendPause() # Ask a running keebie loop (if one exists) to pause so it will detect the new device when we're done
 
     newDevice() # Launch the device addition shell
 
-elif args.remove: # If the user passed --remove
+elif not args.remove == False: # If the user passed --remove (with or without devices)
+    getSettings() # Get settings from the json file in config
+
     sendPause() # Ask a running keebie loop (if one exists) to pause so it will detect the removed device when we're done
 
     removeDevice(args.remove) # Launch the device removal shell
@@ -1269,26 +1748,25 @@ elif args.install: # If the user passed --install
     firstUses() # Perform first time setup
 
 else: # If the user passed nothing
-    try:
-        savePid() # Try to save our PID to the PID file
+    getSettings() # Get settings from the json file in config
 
-    except FileExistsError: # If the PID file already exists
-        try:
-            checkPid() # Check if it is valid, this will raise an error if it isn't
-            print("Another instance of keebie is already processing macros, exiting...") 
-            end()
+    try:
+        savePid() # Try to lock the PID file and save our PID to it
 
-        except ProcessLookupError: # If the PID file pointed to an invalid PID
-            savePid() # Save our PID to the PID file (which checkPid() will have removed)
+    except FileExistsError: # If another instance holds the lock
+        print("Another instance of keebie is already processing macros, exiting...") 
+        end()
 
-    signal.signal(signal.SIGUSR1, pause) # Bind SIGUSR1 to pause()
-    signal.signal(signal.SIGUSR2, resume) # Bind SIGUSR2 to remove()
+    watchSignals({ # Handle these signals from our event loop
+        signal.SIGUSR1: pause, # Bind SIGUSR1 to pause(), other instances use controlSocket but the signals still work from kill
+        signal.SIGUSR2: resume, # Bind SIGUSR2 to resume()
+        signal.SIGCHLD: reapChildren, # Bind SIGCHLD to reapChildren()
+    })
+    openControl() # Receive commands from other instances through controlPath
+    watchLayerDir() # Watch layerDir so we don't need to stat layer files on every keypress
 
-    time.sleep(.5)
-    grabMacroDevices() # Grab all the devices
+    setupMacroDevices() # Setup all devices
+    grabMacroDevices() # Grab all the devices, waiting for any other process to release them
 
     while True : # Enter an infinite loop
-        if paused == False: # If we are not paused
-            readDevices() # Read all devices and process the keycodes
-    
-        time.sleep(settings["loopDelay"]) # Sleep so we don't eat the poor little CPU
+        readDevices() # Wait for events then read and process the devices that have them